@@ -1,7 +1,11 @@
 try:
-    from urllib.parse import urljoin
+    from urllib.parse import urljoin, urlencode, urlparse
 except ImportError:
-    from urlparse import urljoin
+    from urlparse import urljoin, urlparse
+    from urllib import urlencode
+import gzip
+import time
+import threading
 import requests
 import uuid
 from qgis.PyQt.QtCore import QObject
@@ -12,14 +16,158 @@ from carto.gui.authorizedialog import AuthorizeDialog
 from carto.core.utils import (
     setting,
     TOKEN,
+    COMPRESS_REQUESTS,
+    CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+    max_statement_size,
+    split_statements,
+    prepare_multipart_sql,
+)
+from carto.core.jsonstream import JsonRowStream, CHUNK_SIZE
+from carto.core.logging import debug
+from carto.core.cache import QUERY_CACHE, normalize_query
+from carto.core.singleflight import SingleFlight
+from carto.core.scheduler import SCHEDULER, CANCEL_POLL_INTERVAL
+from carto.core.cancellation import current_cancel_token, RequestCanceled
+from carto.core.instrumentation import INSTRUMENTATION
+from carto.core.auth import account_id
+from carto.core.retry import (
+    token_bucket,
+    is_retryable,
+    retry_after,
+    backoff_delay,
+    MAX_RETRIES,
 )
 import os
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
 
 BASE_URL = "https://workspace-gcp-us-east1.app.carto.com"
 SQL_API_URL = "https://gcp-us-east1.api.carto.com"
 USER_URL = "https://accounts.app.carto.com/users/me"
 
+ARROW_STREAM_MIME_TYPE = "application/vnd.apache.arrow.stream"
+
+# Brotli responses can only be decoded if one of its modules is installed
+ACCEPT_ENCODING = "gzip, deflate" if brotli is None else "br, gzip, deflate"
+
+# Queries are sent with POST when their encoded form is longer than this,
+# to stay well below the URL length limits of servers and proxies
+MAX_GET_QUERY_SIZE = 4096
+
+# Smaller request bodies are not worth compressing
+MIN_COMPRESSED_BODY_SIZE = 1024
+
+
+class ColumnarResult:
+    """
+    The result of a query, stored as a list of values for each column
+    instead of a dict for each row
+    """
+
+    def __init__(self, schema, columns, length):
+        self.schema = schema
+        self.columns = columns
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def column(self, name):
+        values = self.columns.get(name)
+        if values is None:
+            return [None] * self.length
+        return values
+
+    def rows(self):
+        names = list(self.columns.keys())
+        return [
+            dict(zip(names, values))
+            for values in zip(*[self.columns[name] for name in names])
+        ]
+
+
+def request_size(kwargs):
+    data = kwargs.get("data") or b""
+    params = kwargs.get("params")
+    return len(data) + (len(urlencode(params)) if params else 0)
+
+
+def _arrow_type_name(field, geom_column=None):
+    # Binary columns are only geometries when they are the geometry column
+    # of the table or carry the geoarrow extension type, not any BLOB
+    extension = (field.metadata or {}).get(b"ARROW:extension:name", b"")
+    if extension.startswith(b"geoarrow"):
+        return "geometry"
+    elif geom_column is not None and field.name.lower() == geom_column.lower():
+        return "geometry"
+    elif pyarrow.types.is_binary(field.type):
+        return "binary"
+    elif pyarrow.types.is_integer(field.type):
+        return "integer"
+    elif pyarrow.types.is_floating(field.type):
+        return "double"
+    elif pyarrow.types.is_boolean(field.type):
+        return "boolean"
+    return "string"
+
+
+def columnar_result_from_arrow(content, geom_column=None):
+    table = pyarrow.ipc.open_stream(content).read_all()
+    schema = [
+        {"name": f.name, "type": _arrow_type_name(f, geom_column)} for f in table.schema
+    ]
+    columns = {name: table.column(name).to_pylist() for name in table.column_names}
+    return ColumnarResult(schema, columns, table.num_rows)
+
+
+def columnar_result_from_stream(stream):
+    columns = {}
+    length = 0
+    for row in stream:
+        for name, value in row.items():
+            values = columns.get(name)
+            if values is None:
+                values = columns[name] = [None] * length
+            values.append(value)
+        length += 1
+        for values in columns.values():
+            if len(values) < length:
+                values.append(None)
+    if "columns" in stream.values:
+        return columnar_result_from_json(stream.values)
+    return ColumnarResult(stream.schema, columns, length)
+
+
+def columnar_result_from_json(_json):
+    schema = _json.get("schema", [])
+    columns = _json.get("columns")
+    if isinstance(columns, dict):
+        length = max((len(v) for v in columns.values()), default=0)
+        return ColumnarResult(schema, columns, length)
+    elif isinstance(columns, list):
+        # Compact format: one array of values per column, in schema order
+        names = [field["name"] for field in schema]
+        length = max((len(v) for v in columns), default=0)
+        return ColumnarResult(schema, dict(zip(names, columns)), length)
+    rows = _json.get("rows", [])
+    names = [field["name"] for field in schema]
+    columns = {name: [row.get(name) for row in rows] for name in names}
+    return ColumnarResult(schema, columns, len(rows))
+
 
 class CartoApi(QObject):
 
@@ -27,9 +175,13 @@ class CartoApi(QObject):
 
     def __init__(self):
         super().__init__()
+        self._flights = SingleFlight()
 
     def set_token(self, token):
         self.token = token
+        # Tokens that are not a JWT can only be told apart by themselves
+        account = (account_id(token) or token) if token is not None else None
+        QUERY_CACHE.set_account(account)
 
     def user(self):
         return self.get(USER_URL)
@@ -37,45 +189,346 @@ class CartoApi(QObject):
     def is_logged_in(self):
         return self.token is not None
 
-    def get(self, endpoint, params=None):
+    def _request(
+        self, method, url, headers=None, stream=False, connectionname=None, **kwargs
+    ):
+        """
+        Sends a request to the API. All requests go through this method,
+        so they share authorization, content encoding negotiation, rate
+        limiting and scheduling per connection, and retries of transient
+        errors
+        """
+        request_headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Accept-Encoding": ACCEPT_ENCODING,
+        }
+        request_headers.update(headers or {})
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+        cancel_token = current_cancel_token()
+        key = connectionname or urlparse(url).netloc
+        bucket = token_bucket(key)
+        attempt = 0
+        while True:
+            if cancel_token is not None:
+                cancel_token.raise_if_canceled()
+            bucket.acquire(cancel_token)
+            response = None
+            try:
+                # The slot is released once the response headers have been
+                # received, so waiting for a retry never holds one
+                with SCHEDULER.slot(key, token=cancel_token):
+                    with INSTRUMENTATION.span(
+                        "request", method=method, url=url.split("?")[0]
+                    ) as span:
+                        INSTRUMENTATION.count("bytes_out", request_size(kwargs))
+                        response = self._send(
+                            method,
+                            url,
+                            key,
+                            cancel_token,
+                            headers=request_headers,
+                            stream=stream,
+                            **kwargs,
+                        )
+                        span["status"] = response.status_code
+                if not is_retryable(method, response=response):
+                    break
+            except requests.exceptions.RequestException as e:
+                if attempt >= MAX_RETRIES or not is_retryable(method, exception=e):
+                    raise
+                reason = str(e)
+            else:
+                if attempt >= MAX_RETRIES:
+                    break
+                reason = f"HTTP {response.status_code}"
+                response.close()
+            delay = retry_after(response)
+            if delay is not None:
+                # The server asked to wait, so every request sent to the
+                # same connection waits too
+                bucket.pause(delay)
+            else:
+                delay = backoff_delay(attempt)
+            attempt += 1
+            debug(
+                f"{method} {url.split('?')[0]} failed ({reason}), "
+                f"retrying in {delay:.1f}s ({attempt}/{MAX_RETRIES})"
+            )
+            if cancel_token is None:
+                time.sleep(delay)
+            elif cancel_token.wait(delay):
+                raise RequestCanceled()
+        if not stream:
+            self._record_received(response, len(response.content))
+        return response
+
+    def _send(self, method, url, key, cancel_token, **kwargs):
+        if cancel_token is None:
+            return requests.request(method, url, **kwargs)
+        # The request runs in a helper thread, so the calling one can stop
+        # waiting as soon as the token is canceled. An abandoned request
+        # ends by itself at the latest when its read timeout expires, and
+        # keeps using a slot of the connection until then
+        result = {}
+        lock = threading.Lock()
+
+        def _run():
+            try:
+                result["response"] = requests.request(method, url, **kwargs)
+            except Exception as e:
+                result["exception"] = e
+            with lock:
+                result["done"] = True
+                abandoned = result.get("abandoned", False)
+            if abandoned:
+                if "response" in result:
+                    result["response"].close()
+                SCHEDULER.release(key)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            thread.join(CANCEL_POLL_INTERVAL)
+            if cancel_token.is_canceled():
+                with lock:
+                    if not result.get("done"):
+                        result["abandoned"] = True
+                        SCHEDULER.hold(key)
+                        raise RequestCanceled()
+                break
+        if "exception" in result:
+            raise result["exception"]
+        if cancel_token.is_canceled():
+            result["response"].close()
+            raise RequestCanceled()
+        return result["response"]
+
+    def _iter_content(self, response):
+        return self._iter_chunks(response, current_cancel_token())
+
+    def _iter_chunks(self, response, cancel_token):
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if cancel_token is not None and cancel_token.is_canceled():
+                # Closing the response releases its socket right away
+                response.close()
+                raise RequestCanceled()
+            size += len(chunk)
+            yield chunk
+        self._record_received(response, size)
+
+    def _record_received(self, response, size):
+        try:
+            # Number of bytes actually read from the socket
+            received = response.raw.tell() or size
+        except Exception:
+            received = size
+        INSTRUMENTATION.count("bytes_in", received)
+        encoding = response.headers.get("Content-Encoding")
+        if encoding and received:
+            debug(
+                f"{response.request.method} {response.url.split('?')[0]}: "
+                f"{received} bytes received, {size} after {encoding} decoding "
+                f"({size / received:.1f}x)"
+            )
+
+    def get(self, endpoint, params=None, headers=None):
         url = urljoin(BASE_URL, endpoint)
-        response = requests.get(
-            url, headers={"Authorization": f"Bearer {self.token}"}, params=params
-        )
+        response = self._request("GET", url, headers=headers, params=params)
         return response
 
     def get_json(self, endpoint, params=None):
-        response = self.get(endpoint, params)
+        # Concurrent identical requests share a single call. They only read
+        # data, so a more urgent caller can send its own instead of waiting
+        key = ("get_json", endpoint, repr(sorted((params or {}).items())))
+        return self._flights.do(
+            key, lambda: self._get_json(endpoint, params), allow_bypass=True
+        )
+
+    def _get_json(self, endpoint, params=None):
+        # The last response is stored with its validators, so the server
+        # can answer with a bodyless 304 if it has not changed
+        key = urljoin(BASE_URL, endpoint)
+        if params:
+            key += "?" + urlencode(sorted(params.items()))
+        cached = QUERY_CACHE.get_response(key)
+        headers = {}
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = self.get(endpoint, params, headers)
+        if response.status_code == 304 and cached is not None:
+            debug(f"GET {key}: not modified, using stored response")
+            INSTRUMENTATION.increment("http_cache_hit")
+            return cached[2]
+        INSTRUMENTATION.increment("http_cache_miss")
         response.raise_for_status()
-        return response.json()
+        with INSTRUMENTATION.span("json_decode"):
+            _json = response.json()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            QUERY_CACHE.put_response(key, etag, last_modified, _json)
+        return _json
 
-    def execute_query(self, connectionname, query):
-        url = urljoin(SQL_API_URL, f"v3/sql/{connectionname}/query")
-        query = f"""
+    def _query_text(self, query, cacheable):
+        """
+        Unless the query is cacheable, a unique comment is added to it, so
+        neither the warehouse nor any proxy returns a cached result
+        """
+        if cacheable:
+            return query
+        return f"""
         -- {uuid.uuid4()}
         {query}
         """
-        print(query)
-        response = requests.get(
-            url,
-            headers={"Authorization": f"Bearer {self.token}"},
-            params={"q": query},
+
+    def execute_query(self, connectionname, query, cacheable=False, cache_class=None):
+        """
+        Runs a query and returns its decoded JSON result. If a cache class
+        is given, the result is stored in the local query cache with the
+        TTL of that class, and the query is sent as cacheable.
+        Concurrent identical cacheable queries share a single call
+        """
+        if cache_class is not None:
+            cacheable = True
+        if not cacheable:
+            return self._execute_query(connectionname, query, False, None)
+        key = ("execute_query", connectionname, normalize_query(query))
+        return self._flights.do(
+            key,
+            lambda: self._execute_query(connectionname, query, True, cache_class),
+            allow_bypass=True,
         )
+
+    def _execute_query(self, connectionname, query, cacheable, cache_class):
+        if cache_class is not None:
+            cached = QUERY_CACHE.get(connectionname, query)
+            if cached is not None:
+                return cached
+        original_query = query
+        query = self._query_text(query, cacheable)
+        response = self._send_query(connectionname, query)
         response.raise_for_status()
-        _json = response.json()
-        print(_json)
+        with INSTRUMENTATION.span("json_decode"):
+            _json = response.json()
+        if cache_class is not None:
+            QUERY_CACHE.put(connectionname, original_query, cache_class, _json)
         return _json
 
-    def execute_query_post(self, connectionname, query):
+    def execute_query_columnar(
+        self, connectionname, query, cacheable=False, geom_column=None
+    ):
+        """
+        Runs a query asking for a columnar result (an Arrow stream if
+        pyarrow is available, or compact JSON arrays) and returns a
+        ColumnarResult. Endpoints that only return rows are also handled.
+        geom_column tells which binary column of an Arrow result holds
+        the geometries
+        """
+        query = self._query_text(query, cacheable)
+        accept = ["application/json;q=0.9"]
+        if pyarrow is not None:
+            accept.insert(0, ARROW_STREAM_MIME_TYPE)
+        response = self._send_query(
+            connectionname, query, headers={"Accept": ", ".join(accept)}, stream=True
+        )
+        with response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            if pyarrow is not None and content_type.startswith(ARROW_STREAM_MIME_TYPE):
+                content = response.content
+                self._record_received(response, len(content))
+                with INSTRUMENTATION.span("arrow_decode"):
+                    return columnar_result_from_arrow(content, geom_column)
+            # Decoding happens while the body is received, so this span
+            # includes the transfer time
+            with INSTRUMENTATION.span("json_stream_decode"):
+                return columnar_result_from_stream(
+                    JsonRowStream(self._iter_content(response))
+                )
+
+    def execute_query_stream(self, connectionname, query, cacheable=False):
+        """
+        Runs a query and yields its rows while the response is being
+        received. The schema is available in the schema attribute of the
+        returned stream
+        """
+        query = self._query_text(query, cacheable)
+        response = self._send_query(connectionname, query, stream=True)
+        response.raise_for_status()
+        return JsonRowStream(self._iter_content(response))
+
+    def execute_statements(self, connectionname, provider_type, fqn, statements):
+        """
+        Runs a list of statements, grouped in as few multi-statement
+        queries as the maximum statement size of the provider allows
+        """
+        max_size = max_statement_size(provider_type)
+        for batch in split_statements(statements, max_size):
+            for statement in prepare_multipart_sql(batch, provider_type, fqn):
+                self.execute_query(connectionname, statement)
+
+    def _send_query(self, connectionname, query, headers=None, stream=False):
+        """
+        Sends a query in the query string of a GET request if it is short
+        enough, or in the body of a POST request otherwise
+        """
+        data = urlencode({"q": query})
+        if len(data) > MAX_GET_QUERY_SIZE:
+            response = self._post_query(connectionname, data, headers, stream)
+        else:
+            url = urljoin(SQL_API_URL, f"v3/sql/{connectionname}/query")
+            response = self._request(
+                "GET",
+                url,
+                headers=headers,
+                params={"q": query},
+                stream=stream,
+                connectionname=connectionname,
+            )
+        # Time until the response headers arrived, mostly spent by the
+        # warehouse running the query
+        seconds = response.elapsed.total_seconds()
+        INSTRUMENTATION.add_time("query_wait", seconds)
+        INSTRUMENTATION.record_query(connectionname, query, seconds)
+        return response
+
+    def _post_query(self, connectionname, data, headers=None, stream=False):
         url = urljoin(SQL_API_URL, f"v3/sql/{connectionname}/query")
-        response = requests.post(
+        data = data.encode()
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if setting(COMPRESS_REQUESTS) and len(data) > MIN_COMPRESSED_BODY_SIZE:
+            compressed = gzip.compress(data)
+            debug(
+                f"POST {url}: {len(data)} bytes sent as {len(compressed)} "
+                f"after gzip compression ({len(data) / len(compressed):.1f}x)"
+            )
+            data = compressed
+            headers["Content-Encoding"] = "gzip"
+        return self._request(
+            "POST",
             url,
-            headers={"Authorization": f"Bearer {self.token}"},
-            data={"q": query},
+            headers=headers,
+            data=data,
+            stream=stream,
+            connectionname=connectionname,
+        )
+
+    def table_tileset(self, connectionname, fqn, geom_column=None):
+        url = urljoin(SQL_API_URL, f"v3/maps/{connectionname}/table")
+        params = {"name": fqn, "formatTiles": "mvt"}
+        if geom_column is not None:
+            params["geo_column"] = geom_column
+        response = self._request(
+            "GET", url, params=params, connectionname=connectionname
         )
         response.raise_for_status()
-        _json = response.json()
-        return _json
+        return response.json()
 
     def connections(self):
         try:
@@ -146,6 +146,20 @@ def generate_challenge(a_verifier):
     return auth0_url_encode(hashlib.sha256(a_verifier.encode()).digest())
 
 
+def account_id(token):
+    """
+    Returns the user id (the sub claim) of an access token, which stays
+    the same when the token is refreshed. Returns None if the token is
+    not a JWT
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("sub")
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
 class OAuthWorkflow(QThread):
     """
     A custom thread which handles the OAuth workflow.
@@ -0,0 +1,61 @@
+from qgis.core import QgsApplication, QgsAuthMethodConfig
+
+# Authentication method that adds fixed headers to requests. It is not
+# available in QGIS versions older than 3.28
+API_HEADER_METHOD = "APIHeader"
+AUTH_CONFIG_NAME = "CARTO"
+
+
+class AuthConfigError(Exception):
+    pass
+
+
+def _find_config():
+    manager = QgsApplication.authManager()
+    for config_id, config in manager.availableAuthMethodConfigs().items():
+        if config.name() == AUTH_CONFIG_NAME and config.method() == API_HEADER_METHOD:
+            return config_id
+    return None
+
+
+def bearer_auth_config(token):
+    """
+    Returns the id of the authentication configuration that sends the
+    given token in the Authorization header, creating or updating it as
+    needed. Layers reference the configuration instead of the token, so
+    the token is stored in the encrypted QGIS authentication database
+    and not in project files
+    """
+    manager = QgsApplication.authManager()
+    if API_HEADER_METHOD not in manager.authMethodsKeys():
+        raise AuthConfigError(
+            "This QGIS version does not support API header authentication"
+        )
+    # Asks the user for the master password if it has not been set yet
+    if not manager.setMasterPassword(True):
+        raise AuthConfigError("The authentication database could not be unlocked")
+    config = QgsAuthMethodConfig(API_HEADER_METHOD)
+    config_id = _find_config()
+    if config_id is not None:
+        manager.loadAuthenticationConfig(config_id, config, True)
+        config.setConfigMap({"Authorization": f"Bearer {token}"})
+        stored = manager.updateAuthenticationConfig(config)
+    else:
+        # The id is set here, so it is known whatever the bindings of
+        # storeAuthenticationConfig return
+        config_id = manager.uniqueConfigId()
+        config.setId(config_id)
+        config.setName(AUTH_CONFIG_NAME)
+        config.setConfigMap({"Authorization": f"Bearer {token}"})
+        stored = manager.storeAuthenticationConfig(config)
+        if isinstance(stored, tuple):
+            stored = stored[0]
+    if not stored:
+        raise AuthConfigError("The token could not be stored")
+    return config_id
+
+
+def remove_bearer_auth_config():
+    config_id = _find_config()
+    if config_id is not None:
+        QgsApplication.authManager().removeAuthenticationConfig(config_id)
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from qgis.core import QgsApplication
+
+from carto.core.logging import error
+from carto.core.instrumentation import INSTRUMENTATION
+
+# Time to live in seconds for each class of cached query
+QUERY_CACHE_TTLS = {
+    "metadata": 3600,
+    "listing": 600,
+    "count": 300,
+    "preview": 300,
+}
+
+# Least recently used entries are removed when the cached results take
+# more than this number of bytes
+MAX_CACHE_BYTES = 50 * 1024 * 1024
+
+# Maximum number of API responses stored with their validators
+MAX_CACHED_RESPONSES = 1000
+
+
+def normalize_query(query):
+    return " ".join(query.split()).rstrip(";").strip()
+
+
+class QueryCache:
+    """
+    Stores the results of read-only queries in a SQLite database, so
+    identical queries are not sent again while their result is fresh.
+    Entries are keyed by account, connection and normalized SQL, expire
+    after the TTL of their query class, and are evicted in LRU order to
+    keep the database under a size budget
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_CACHE_BYTES):
+        self._path = path
+        self.max_bytes = max_bytes
+        self.account = None
+        self._db = None
+        self._lock = threading.Lock()
+
+    def set_account(self, account):
+        """
+        Sets the account whose results are read and stored. Everything
+        cached is removed when a different account logs in, so results
+        of an account are never kept along with those of another one
+        """
+        if account is None:
+            self.account = None
+            return
+        self.account = hashlib.sha256(account.encode()).hexdigest()
+        try:
+            with self._lock:
+                db = self._connection()
+                row = db.execute(
+                    "SELECT value FROM cache_info WHERE name = 'account'"
+                ).fetchone()
+                if row is not None and row[0] == self.account:
+                    return
+                db.execute("DELETE FROM query_cache")
+                db.execute("DELETE FROM http_cache")
+                db.execute(
+                    "INSERT OR REPLACE INTO cache_info (name, value) VALUES ('account', ?)",
+                    (self.account,),
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            error(f"Could not clear query cache: {e}")
+
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(
+                os.path.dirname(QgsApplication.qgisUserDatabaseFilePath()),
+                "cartocache.sqlite",
+            )
+        return self._path
+
+    def _connection(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path()), exist_ok=True)
+            # Access is serialized with a lock, so the connection can be
+            # shared by the threads of QGIS tasks
+            self._db = sqlite3.connect(self.path(), check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS query_cache (
+                    key TEXT PRIMARY KEY,
+                    connection TEXT,
+                    query_class TEXT,
+                    value TEXT,
+                    size INTEGER,
+                    expires REAL,
+                    accessed REAL
+                )""")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS query_cache_connection ON query_cache (connection)"
+            )
+            self._db.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    value TEXT,
+                    accessed REAL
+                )""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS cache_info (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )""")
+        return self._db
+
+    def key(self, connection, query):
+        normalized = normalize_query(query)
+        return hashlib.sha256(
+            f"{self.account}\n{connection}\n{normalized}".encode()
+        ).hexdigest()
+
+    def response_key(self, url):
+        return hashlib.sha256(f"{self.account}\n{url}".encode()).hexdigest()
+
+    def get(self, connection, query):
+        key = self.key(connection, query)
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connection()
+                row = db.execute(
+                    "SELECT value, expires FROM query_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    INSTRUMENTATION.increment("query_cache_miss")
+                    return None
+                value, expires = row
+                if expires < now:
+                    db.execute("DELETE FROM query_cache WHERE key = ?", (key,))
+                    db.commit()
+                    INSTRUMENTATION.increment("query_cache_miss")
+                    return None
+                db.execute(
+                    "UPDATE query_cache SET accessed = ? WHERE key = ?", (now, key)
+                )
+                db.commit()
+            INSTRUMENTATION.increment("query_cache_hit")
+            return json.loads(value)
+        except sqlite3.Error as e:
+            error(f"Could not read query cache: {e}")
+            return None
+
+    def put(self, connection, query, query_class, result):
+        ttl = QUERY_CACHE_TTLS[query_class]
+        value = json.dumps(result)
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connection()
+                db.execute(
+                    """INSERT OR REPLACE INTO query_cache
+                        (key, connection, query_class, value, size, expires, accessed)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        self.key(connection, query),
+                        connection,
+                        query_class,
+                        value,
+                        len(value),
+                        now + ttl,
+                        now,
+                    ),
+                )
+                self._evict(db, now)
+                db.commit()
+        except sqlite3.Error as e:
+            error(f"Could not write query cache: {e}")
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM query_cache WHERE expires < ?", (now,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM query_cache").fetchone()[
+            0
+        ]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in db.execute(
+            "SELECT key, size FROM query_cache ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        db.executemany("DELETE FROM query_cache WHERE key = ?", evicted)
+
+    def get_response(self, url):
+        """
+        Returns the (etag, last modified, value) tuple stored for an API
+        response, or None if there is none
+        """
+        key = self.response_key(url)
+        try:
+            with self._lock:
+                db = self._connection()
+                row = db.execute(
+                    "SELECT etag, last_modified, value FROM http_cache WHERE url = ?",
+                    (key,),
+                ).fetchone()
+                if row is None:
+                    return None
+                db.execute(
+                    "UPDATE http_cache SET accessed = ? WHERE url = ?",
+                    (time.time(), key),
+                )
+                db.commit()
+            etag, last_modified, value = row
+            return etag, last_modified, json.loads(value)
+        except sqlite3.Error as e:
+            error(f"Could not read query cache: {e}")
+            return None
+
+    def put_response(self, url, etag, last_modified, result):
+        try:
+            with self._lock:
+                db = self._connection()
+                db.execute(
+                    """INSERT OR REPLACE INTO http_cache
+                        (url, etag, last_modified, value, accessed)
+                        VALUES (?, ?, ?, ?, ?)""",
+                    (
+                        self.response_key(url),
+                        etag,
+                        last_modified,
+                        json.dumps(result),
+                        time.time(),
+                    ),
+                )
+                db.execute(
+                    """DELETE FROM http_cache WHERE url NOT IN
+                        (SELECT url FROM http_cache ORDER BY accessed DESC LIMIT ?)""",
+                    (MAX_CACHED_RESPONSES,),
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            error(f"Could not write query cache: {e}")
+
+    def invalidate(self, connection=None):
+        """
+        Removes the cached results of a connection, or all of them if no
+        connection is given. Must be called after modifying data
+        """
+        try:
+            with self._lock:
+                db = self._connection()
+                if connection is None:
+                    db.execute("DELETE FROM query_cache")
+                else:
+                    db.execute(
+                        "DELETE FROM query_cache WHERE connection = ?", (connection,)
+                    )
+                db.commit()
+        except sqlite3.Error as e:
+            error(f"Could not clear query cache: {e}")
+
+
+QUERY_CACHE = QueryCache()
@@ -0,0 +1,54 @@
+import threading
+from contextlib import contextmanager
+
+
+class RequestCanceled(Exception):
+    pass
+
+
+class CancellationToken:
+    """
+    Flag shared between a task and the requests it makes. Canceling it
+    makes the requests waiting for a response, a retry or a transfer
+    chunk stop as soon as they notice it
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def is_canceled(self):
+        return self._event.is_set()
+
+    def raise_if_canceled(self):
+        if self._event.is_set():
+            raise RequestCanceled()
+
+    def wait(self, seconds):
+        """
+        Sleeps for the given time, returning earlier (and True) if the
+        token is canceled
+        """
+        return self._event.wait(seconds)
+
+
+_local = threading.local()
+
+
+def current_cancel_token():
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def cancellation_scope(token):
+    """
+    Makes the requests sent by the current thread use the given token
+    """
+    previous = getattr(_local, "token", None)
+    _local.token = token
+    try:
+        yield
+    finally:
+        _local.token = previous
@@ -5,6 +5,7 @@ from carto.gui.utils import waitcursor
 from carto.core.importlayertask import ImportLayerTask
 from carto.gui.authorization_manager import AUTHORIZATION_MANAGER
 from carto.core.enums import AuthState
+from carto.core.singleflight import SingleFlight
 
 from qgis.core import (
     QgsVectorLayer,
@@ -16,6 +17,8 @@ from qgis.PyQt.QtCore import QObject, pyqtSignal, QCoreApplication
 
 from qgis.utils import iface
 
+_can_write_flights = SingleFlight()
+
 
 class CartoConnection(QObject):
 
@@ -154,9 +157,9 @@ class Schema:
                         AND g.table_name = s.table_name
                     ORDER BY g.table_name;
                 """
-                tables = CARTO_API.execute_query(self.database.connection.name, query)[
-                    "rows"
-                ]
+                tables = CARTO_API.execute_query(
+                    self.database.connection.name, query, cache_class="listing"
+                )["rows"]
                 self._tables = [
                     Table(
                         table["table_name"],
@@ -182,23 +185,29 @@ class Schema:
     @waitcursor
     def can_write(self):
         if self._can_write is None:
-            fqn = quote_for_provider(
-                f"{self.database.databaseid}.{self.schemaid}.__qgis_test_table",
-                self.database.connection.provider_type,
-            )
-            sql = [
-                f"DROP TABLE IF EXISTS {fqn};",
-                f"CREATE TABLE {fqn} AS (SELECT 1 AS id);",
-                f"DROP TABLE {fqn};",
-            ]
-            try:
-                for statement in sql:
-                    CARTO_API.execute_query(self.database.connection.name, statement)
-                self._can_write = True
-            except Exception as e:
-                self._can_write = False
+            # Only one test table is created at a time for each schema, even
+            # if several downloads ask for it at once
+            key = f"{self.database.connection.name}.{self.database.databaseid}.{self.schemaid}"
+            self._can_write = _can_write_flights.do(key, self._test_can_write)
         return self._can_write
 
+    def _test_can_write(self):
+        fqn = quote_for_provider(
+            f"{self.database.databaseid}.{self.schemaid}.__qgis_test_table",
+            self.database.connection.provider_type,
+        )
+        sql = [
+            f"DROP TABLE IF EXISTS {fqn};",
+            f"CREATE TABLE {fqn} AS (SELECT 1 AS id);",
+            f"DROP TABLE {fqn};",
+        ]
+        try:
+            for statement in sql:
+                CARTO_API.execute_query(self.database.connection.name, statement)
+            return True
+        except Exception:
+            return False
+
     @waitcursor
     def import_table(self, file_or_layer, tablename):
         if isinstance(file_or_layer, QgsMapLayer):
@@ -271,6 +280,14 @@ class Table:
     def geom_column(self):
         return self.table_info()["geomField"]
 
+    @waitcursor
+    def tileset(self):
+        return CARTO_API.table_tileset(
+            self.schema.database.connection.name,
+            f"{self.schema.database.databaseid}.{self.schema.schemaid}.{self.tableid}",
+            self.geom_column(),
+        )
+
     @waitcursor
     def pk(self):
         if self.schema.database.connection.provider_type == "bigquery":
@@ -321,7 +338,9 @@ class Table:
                     """
         else:
             return None
-        ret = CARTO_API.execute_query(self.schema.database.connection.name, sql)
+        ret = CARTO_API.execute_query(
+            self.schema.database.connection.name, sql, cache_class="metadata"
+        )
         if len(ret["rows"]) > 0:
             return ret["rows"][0]["column_name"]
         return None
@@ -336,6 +355,7 @@ class Table:
             self.schema.database.connection.name,
             f"""SELECT * FROM {fqn}
                 WHERE {where} ;""",
+            cache_class="preview",
         )
 
     def _filepath(self):
@@ -1,10 +1,15 @@
 import traceback
 import os
 import base64
+import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 from qgis.core import (
     QgsTask,
-    QgsGeometry,
 )
 
 from carto.core.layers import save_layer_metadata, filepath_for_table
@@ -15,12 +20,26 @@ from carto.core.logging import (
 
 from carto.core.utils import (
     quote_for_provider,
+    quote_column_name_for_provider,
+    simplified_geometry_for_provider,
     download_file,
 )
 
 from carto.core.api import (
     CARTO_API,
 )
+from carto.core.spatialfilter import spatial_predicate_for_table
+from carto.core.scheduler import request_priority, BULK
+from carto.core.instrumentation import (
+    INSTRUMENTATION,
+    current_task_stats,
+    task_scope,
+)
+from carto.core.cancellation import (
+    CancellationToken,
+    RequestCanceled,
+    cancellation_scope,
+)
 
 from qgis.core import (
     QgsVectorLayer,
@@ -32,23 +51,403 @@ from qgis.core import (
     QgsVectorFileWriter,
     QgsCoordinateReferenceSystem,
     QgsProject,
+    QgsRectangle,
     QgsWkbTypes,
 )
 
 
 from qgis.PyQt.QtCore import QVariant
 
+TILES_PER_SIDE = 4
+MAX_PARALLEL_REQUESTS = 4
+MAX_QUEUED_PAGES = 8
+
+
+def fields_from_schema(schema):
+    fields = QgsFields()
+    geom_field = None
+    for field in schema:
+        field_name = field["name"]
+        field_type = field["type"]
+        if field_type == "string":
+            fields.append(QgsField(field_name, QVariant.String))
+        elif field_type in ["integer", "int", "bigint"]:
+            fields.append(QgsField(field_name, QVariant.Int))
+        elif field_type in ["double", "number", "float"]:
+            fields.append(QgsField(field_name, QVariant.Double))
+        elif field_type == "geometry":
+            geom_field = field_name
+    return fields, geom_field
+
+
+def geometry_from_value(g):
+    if isinstance(g, (bytes, bytearray)):
+        # Binary columns of columnar results already contain WKB
+        qgsgeom = QgsGeometry()
+        qgsgeom.fromWkb(bytes(g))
+        return qgsgeom
+    try:
+        wkb_bytes = base64.b64decode(g)
+        qgsgeom = QgsGeometry()
+        qgsgeom.fromWkb(wkb_bytes)
+        return qgsgeom
+    except Exception:
+        pass
+    try:
+        qgsgeom = QgsGeometry.fromWkt(g)
+        if not qgsgeom.isNull():
+            return qgsgeom
+    except Exception:
+        pass
+    try:
+        geom_type = g.get("type")
+        coordinates = g.get("coordinates", [])
+        if geom_type == "Point" and len(coordinates) == 2:
+            point = QgsPointXY(coordinates[0], coordinates[1])
+            return QgsGeometry.fromPointXY(point)
+        elif geom_type == "LineString":
+            line = [QgsPointXY(x, y) for x, y in coordinates]
+            return QgsGeometry.fromPolylineXY(line)
+        elif geom_type == "Polygon":
+            polygon = [[QgsPointXY(x, y) for x, y in ring] for ring in coordinates]
+            return QgsGeometry.fromPolygonXY(polygon)
+        elif geom_type == "MultiPoint":
+            multipoint = [QgsPointXY(x, y) for x, y in coordinates]
+            return QgsGeometry.fromMultiPointXY(multipoint)
+        elif geom_type == "MultiLineString":
+            multiline = [[QgsPointXY(x, y) for x, y in line] for line in coordinates]
+            return QgsGeometry.fromMultiPolylineXY(multiline)
+        elif geom_type == "MultiPolygon":
+            multipolygon = [
+                [[QgsPointXY(x, y) for x, y in ring] for ring in polygon]
+                for polygon in coordinates
+            ]
+            return QgsGeometry.fromMultiPolygonXY(multipolygon)
+    except Exception as e:
+        print(e)
+    return None
+
+
+def geometry_type_from_rows(rows, geom_field, provider_type):
+    if geom_field is None:
+        return None
+    for row in rows:
+        geom = row.get(geom_field)
+        if geom is None:
+            continue
+        # Columnar results carry WKB for every provider, and Databricks
+        # returns encoded geometries instead of GeoJSON
+        if isinstance(geom, (bytes, bytearray)) or provider_type == "databricksRest":
+            try:
+                qgsgeom = geometry_from_value(geom)
+                if qgsgeom is not None and qgsgeom.isGeosValid():
+                    return QgsWkbTypes.displayString(qgsgeom.wkbType())
+            except Exception:
+                pass
+        try:
+            geom_type = geom.get("type")
+        except Exception:
+            geom_type = None
+        if geom_type is not None:
+            return geom_type
+    return None
+
+
+class FeatureBuilder:
+    """
+    Creates features from the rows of a query result. The field names and
+    a prototype feature that already has the fields set are computed only
+    once, so each row just needs a copy of the prototype and a list of
+    attributes in field order
+    """
+
+    def __init__(self, fields, geom_field):
+        self.names = fields.names()
+        self.geom_field = geom_field
+        self.prototype = QgsFeature(fields)
+
+    def feature(self, row):
+        # Copies of a feature share its fields instead of duplicating them
+        feature = QgsFeature(self.prototype)
+        get = row.get
+        feature.setAttributes([get(name) for name in self.names])
+        geom = get(self.geom_field)
+        if geom is not None:
+            qgsgeom = geometry_from_value(geom)
+            if qgsgeom is not None:
+                feature.setGeometry(qgsgeom)
+        return feature
+
+    def features(self, rows):
+        values = (
+            ([row.get(name) for name in self.names], row.get(self.geom_field))
+            for row in rows
+        )
+        return self._build(values, len(rows))
+
+    def features_from_columns(self, result):
+        if self.names:
+            attribute_lists = zip(*[result.column(name) for name in self.names])
+        else:
+            attribute_lists = ([] for _ in range(len(result)))
+        values = zip(attribute_lists, result.column(self.geom_field))
+        return self._build(values, len(result))
+
+    def _build(self, values, count):
+        features = []
+        prototype = self.prototype
+        geometry_time = 0
+        with INSTRUMENTATION.span("feature_decode", features=count):
+            for attributes, geom in values:
+                feature = QgsFeature(prototype)
+                feature.setAttributes(list(attributes))
+                if geom is not None:
+                    start = time.perf_counter()
+                    qgsgeom = geometry_from_value(geom)
+                    geometry_time += time.perf_counter() - start
+                    if qgsgeom is not None:
+                        feature.setGeometry(qgsgeom)
+                features.append(feature)
+        INSTRUMENTATION.add_time("geometry_decode", geometry_time)
+        return features
+
+
+def row_key(row, pk):
+    if pk is not None and pk in row:
+        return row[pk]
+    return json.dumps(row, sort_keys=True, default=str)
+
+
+def split_rectangle(rectangle, tiles_per_side):
+    width = rectangle.width() / tiles_per_side
+    height = rectangle.height() / tiles_per_side
+    return [
+        QgsRectangle(
+            rectangle.xMinimum() + i * width,
+            rectangle.yMinimum() + j * height,
+            rectangle.xMinimum() + (i + 1) * width,
+            rectangle.yMinimum() + (j + 1) * height,
+        )
+        for i in range(tiles_per_side)
+        for j in range(tiles_per_side)
+    ]
+
+
+_DONE = object()
+
+
+class PagePipeline:
+    """
+    Fetches the pages of a query using several threads and decodes them
+    into features in another one, while the caller adds the decoded
+    features to the layer. Queues between stages are bounded, so fetching
+    waits when decoding or writing can not keep up, and memory use stays
+    limited to a few pages
+    """
+
+    def __init__(
+        self,
+        fetch_page,
+        decode_page,
+        start_offset,
+        page_size,
+        limit=None,
+        fetchers=MAX_PARALLEL_REQUESTS,
+        decoders=1,
+        max_queued_pages=MAX_QUEUED_PAGES,
+    ):
+        self.fetch_page = fetch_page
+        self.decode_page = decode_page
+        self.start_offset = start_offset
+        self.page_size = page_size
+        self.limit = limit
+        self.fetchers = fetchers
+        self.decoders = decoders
+        self.error = None
+        self._fetched = queue.Queue(max_queued_pages)
+        self._decoded = queue.Queue(max_queued_pages)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._next_page = 0
+        self._last_page = None
+        self._running_fetchers = fetchers
+        self._running_decoders = decoders
+        # Work done by the threads of the pipeline is attributed to the
+        # task that created it
+        self.stats = current_task_stats()
+
+    def pages(self):
+        """
+        Yields (number of rows, features) tuples for each page, in the
+        order in which they are decoded
+        """
+        threads = [
+            threading.Thread(
+                target=self._in_task_scope, args=(self._fetch,), daemon=True
+            )
+            for _ in range(self.fetchers)
+        ] + [
+            threading.Thread(
+                target=self._in_task_scope, args=(self._decode,), daemon=True
+            )
+            for _ in range(self.decoders)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(self._decoded)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self._stop.set()
+
+    def _in_task_scope(self, func):
+        with task_scope(self.stats):
+            func()
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, e):
+        if self.error is None:
+            self.error = e
+        self._stop.set()
+
+    def _fetch(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    index = self._next_page
+                    self._next_page += 1
+                    last_page = self._last_page
+                if last_page is not None and index > last_page:
+                    break
+                offset = self.start_offset + index * self.page_size
+                size = self.page_size
+                if self.limit:
+                    size = min(size, self.limit - offset)
+                if size <= 0:
+                    break
+                rows = self.fetch_page(offset, size)
+                if len(rows) < size:
+                    with self._lock:
+                        if self._last_page is None or index < self._last_page:
+                            self._last_page = index
+                self._put(self._fetched, rows)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._lock:
+                self._running_fetchers -= 1
+                finished = self._running_fetchers == 0
+            if finished:
+                for _ in range(self.decoders):
+                    self._put(self._fetched, _DONE)
+
+    def _decode(self):
+        try:
+            while True:
+                rows = self._get(self._fetched)
+                if rows is _DONE:
+                    break
+                self._put(self._decoded, (len(rows), self.decode_page(rows)))
+        except Exception as e:
+            self._fail(e)
+        finally:
+            with self._lock:
+                self._running_decoders -= 1
+                finished = self._running_decoders == 0
+            if finished:
+                self._put(self._decoded, _DONE)
+
 
 class DownloadTableTask(QgsTask):
-    def __init__(self, table, where, limit):
+
+    def __init__(self, table, where, limit, tolerance=None, columns=None, extent=None):
         super().__init__(f"Download table {table.name}", QgsTask.CanCancel)
         self.exception = None
         self.table = table
         self.where = where
         self.limit = limit
+        self.tolerance = tolerance
+        self.columns = columns
+        self.extent = extent
+        self.geom_column = table.geom_column()
+        self.predicate = (
+            spatial_predicate_for_table(table) if extent is not None else None
+        )
+        self.select = self._select_expression()
         self.layer = None
+        self._stop_tiles = threading.Event()
+        self.cancel_token = CancellationToken()
+        # The row count has its own token, since it must also stop when
+        # the download ends before it
+        self.count_token = CancellationToken()
+        self.stats = None
+
+    def cancel(self):
+        # Requests in flight are abandoned instead of waiting for them
+        self.cancel_token.cancel()
+        self.count_token.cancel()
+        super().cancel()
+
+    def _select_expression(self):
+        if self.tolerance is None and self.columns is None:
+            return "*"
+        provider_type = self.table.schema.database.connection.provider_type
+        geom_column = self.geom_column
+        if self.columns is None:
+            columns = [c["name"] for c in self.table.columns()]
+        else:
+            pk = self.table.pk()
+            columns = [
+                c["name"]
+                for c in self.table.columns()
+                if c["name"] in self.columns or c["name"] in (pk, geom_column)
+            ]
+        expressions = []
+        for column in columns:
+            quoted_column = quote_column_name_for_provider(column, provider_type)
+            if column == geom_column and self.tolerance is not None:
+                simplified = simplified_geometry_for_provider(
+                    provider_type, quoted_column, self.tolerance
+                )
+                expressions.append(f"{simplified} AS {quoted_column}")
+            else:
+                expressions.append(quoted_column)
+        return ", ".join(expressions)
 
     def run(self):
+        self.stats = INSTRUMENTATION.start_task(self.description())
+        try:
+            with task_scope(self.stats):
+                return self._run()
+        finally:
+            INSTRUMENTATION.finish_task(self.stats)
+
+    def _run(self):
+        if self.extent is not None:
+            return self._download_tiled()
         if self.table.schema.database.connection.provider_type == "bigquery":
             return self._download_using_sql()
             # self._download_bigquery()
@@ -69,7 +468,7 @@ class DownloadTableTask(QgsTask):
             url = ret["rows"][0]["result"]
             geopackage_file = self._filepath()
             os.makedirs(os.path.dirname(geopackage_file), exist_ok=True)
-            download_file(url, geopackage_file)
+            download_file(url, geopackage_file, self.cancel_token)
 
             gpkglayer = QgsVectorLayer(geopackage_file, self.name, "ogr")
             gpkglayer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
@@ -85,6 +484,8 @@ class DownloadTableTask(QgsTask):
             save_layer_metadata(gpkglayer, layer_metadata)
             self.layer = gpkglayer
             return True
+        except RequestCanceled:
+            return False
         except Exception:
             self.exception = traceback.format_exc()
             error(self.exception)
@@ -94,160 +495,180 @@ class DownloadTableTask(QgsTask):
         try:
             self.setProgress(1)
             batch_size = min(100, self.limit or 100)
-            offset = 0
-            row_count = self.row_count()
-            if row_count == 0:
+            row_count = None
+            # The row count is only used to report progress, so it never
+            # delays the first page
+            executor = ThreadPoolExecutor(max_workers=1)
+            if self.where.strip().upper() == "TRUE":
+                count = self.estimated_row_count
+            else:
+                count = self.row_count
+            row_count_future = executor.submit(self._count_rows, count)
+            executor.shutdown(wait=False)
+            page_size = batch_size
+            if self.limit:
+                page_size = min(batch_size, self.limit)
+            result = self.get_columns(f"{self.where} LIMIT {page_size} OFFSET 0")
+            if len(result) == 0:
                 self.layer = None
                 return True
-            max_rows = min(self.limit or row_count, row_count)
-            while True:
-                where_with_offset = f"{self.where} LIMIT {batch_size} OFFSET {offset}"
-                data = self.get_rows(where_with_offset)
-                rows = data.get("rows", [])
-                if offset == 0:
-                    schema = data.get("schema", [])
-                    fields = QgsFields()
-                    geom_field = None
-                    for field in schema:
-                        field_name = field["name"]
-                        field_type = field["type"]
-                        if field_type == "string":
-                            fields.append(QgsField(field_name, QVariant.String))
-                        elif field_type in ["integer", "int", "bigint"]:
-                            fields.append(QgsField(field_name, QVariant.Int))
-                        elif field_type in ["double", "number", "float"]:
-                            fields.append(QgsField(field_name, QVariant.Double))
-                        elif field_type == "geometry":
-                            geom_field = field_name
-                    provider_type = self.table.schema.database.connection.provider_type
-                    geom_type = None
-                    if geom_field is not None:
-                        for row in rows:
-                            geom = row.get(geom_field)
-                            if geom is not None:
-                                if provider_type == "databricksRest":
-                                    try:
-                                        wkb_bytes = base64.b64decode(geom)
-                                        qgsgeom = QgsGeometry()
-                                        qgsgeom.fromWkb(wkb_bytes)
-                                        if qgsgeom.isGeosValid():
-                                            geom_type = QgsWkbTypes.displayString(
-                                                qgsgeom.wkbType()
-                                            )
-                                    except Exception:
-                                        try:
-                                            qgsgeom.fromWkt(geom)
-                                            if qgsgeom.isGeosValid():
-                                                geom_type = QgsWkbTypes.displayString(
-                                                    qgsgeom.wkbType()
-                                                )
-                                        except Exception:
-                                            try:
-                                                geom_type = geom.get("type")
-                                            except Exception:
-                                                geom_type = None
-                                else:
-                                    geom_type = geom.get("type")
-                                if geom_type is not None:
-                                    break
-                    layer = QgsVectorLayer(
-                        f"{geom_type}?crs=EPSG:4326", self.table.name, "memory"
-                    )
-                    provider = layer.dataProvider()
-                    provider.addAttributes(fields)
-                    layer.updateFields()
-                    layer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
+            schema = result.schema
+            layer, fields, geom_field = self._create_memory_layer(schema, result.rows())
+            provider = layer.dataProvider()
+            builder = FeatureBuilder(fields, geom_field)
+            self._write_features(provider, builder.features_from_columns(result))
+            offset = len(result)
 
-                if len(rows) == 0:
-                    break
+            if len(result) == page_size and not (self.limit and offset >= self.limit):
+                # Remaining pages are fetched and decoded in other threads,
+                # while this one adds the decoded features to the layer
+                pipeline = PagePipeline(
+                    lambda page_offset, size: self.get_columns(
+                        f"{self.where} LIMIT {size} OFFSET {page_offset}"
+                    ),
+                    builder.features_from_columns,
+                    offset,
+                    batch_size,
+                    self.limit,
+                )
+                for page_row_count, features in pipeline.pages():
+                    if self.isCanceled():
+                        pipeline.stop()
+                        return False
 
-                if self.isCanceled():
-                    return False
+                    self._write_features(provider, features)
 
-                def _set_geometry(f, g):
-                    try:
-                        wkb_bytes = base64.b64decode(g)
-                        qgsgeom = QgsGeometry()
-                        qgsgeom.fromWkb(wkb_bytes)
-                        f.setGeometry(qgsgeom)
-                    except Exception:
+                    offset += page_row_count
+                    if row_count is None and row_count_future.done():
                         try:
-                            qgsgeom.fromWkt(g)
-                            f.setGeometry(qgsgeom)
+                            row_count = row_count_future.result() or 0
                         except Exception:
-                            try:
-                                geom_type = g.get("type")
-                                coordinates = g.get("coordinates", [])
-                                if geom_type == "Point" and len(coordinates) == 2:
-                                    point = QgsPointXY(coordinates[0], coordinates[1])
-                                    f.setGeometry(QgsGeometry.fromPointXY(point))
-                                elif geom_type == "LineString":
-                                    line = [QgsPointXY(x, y) for x, y in coordinates]
-                                    f.setGeometry(QgsGeometry.fromPolylineXY(line))
-                                elif geom_type == "Polygon":
-                                    polygon = [
-                                        [QgsPointXY(x, y) for x, y in ring]
-                                        for ring in coordinates
-                                    ]
-                                    f.setGeometry(QgsGeometry.fromPolygonXY(polygon))
-                                elif geom_type == "MultiPoint":
-                                    multipoint = [
-                                        QgsPointXY(x, y) for x, y in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPointXY(multipoint)
-                                    )
-                                elif geom_type == "MultiLineString":
-                                    multiline = [
-                                        [QgsPointXY(x, y) for x, y in line]
-                                        for line in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPolylineXY(multiline)
-                                    )
-                                elif geom_type == "MultiPolygon":
-                                    multipolygon = [
-                                        [
-                                            [QgsPointXY(x, y) for x, y in ring]
-                                            for ring in polygon
-                                        ]
-                                        for polygon in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPolygonXY(multipolygon)
-                                    )
-                            except Exception as e:
-                                print(e)
-
-                for item in rows:
-                    feature = QgsFeature()
-                    feature.setFields(fields)
-
-                    for field in fields:
-                        feature.setAttribute(field.name(), item.get(field.name()))
-
-                    geom = item.get(geom_field)
-                    if geom is not None:
-                        _set_geometry(feature, geom)
-
-                    provider.addFeature(feature)
-
-                if offset + batch_size >= max_rows:
-                    break
-                offset += batch_size
-                self.setProgress(min((offset + batch_size) / row_count, 1) * 90)
+                            row_count = 0
+                    expected_rows = min(
+                        [n for n in (row_count, self.limit) if n]
+                        or [offset + batch_size]
+                    )
+                    self.setProgress(min(offset / max(expected_rows, 1), 1) * 90)
 
-            geopackage_file = filepath_for_table(
-                self.table.schema.database.connection.name,
-                self.table.schema.database.databaseid,
-                self.table.schema.schemaid,
-                self.table.tableid,
-            )
-            os.makedirs(os.path.dirname(geopackage_file), exist_ok=True)
+            self._save_geopackage(layer, schema, geom_field)
+
+            return True
+        except RequestCanceled:
+            return False
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+        finally:
+            self.count_token.cancel()
 
-            options = QgsVectorFileWriter.SaveVectorOptions()
-            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
-            options.layerName = layer.name()
+    def _download_tiled(self):
+        """
+        Splits the extent in tiles that are downloaded in parallel.
+        Features crossing tile borders are returned for more than one
+        tile, so they are deduplicated using the primary key
+        """
+        try:
+            self.setProgress(1)
+            pk = self.table.pk()
+            tiles = split_rectangle(self.extent, TILES_PER_SIDE)
+            layer = None
+            seen = set()
+            count = 0
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+                futures = [executor.submit(self._tile_rows, tile) for tile in tiles]
+                try:
+                    for done, future in enumerate(as_completed(futures), 1):
+                        schema, rows = future.result()
+                        if self.isCanceled():
+                            return False
+                        unique_rows = []
+                        for row in rows:
+                            key = row_key(row, pk)
+                            if key not in seen:
+                                seen.add(key)
+                                unique_rows.append(row)
+                        if self.limit:
+                            unique_rows = unique_rows[: self.limit - count]
+                        if unique_rows:
+                            if layer is None:
+                                layer, fields, geom_field = self._create_memory_layer(
+                                    schema, unique_rows
+                                )
+                                layer_schema = schema
+                                provider = layer.dataProvider()
+                                builder = FeatureBuilder(fields, geom_field)
+                            self._write_features(
+                                provider, builder.features(unique_rows)
+                            )
+                            count += len(unique_rows)
+                        self.setProgress(done / len(tiles) * 90)
+                        if self.limit and count >= self.limit:
+                            break
+                finally:
+                    self._stop_tiles.set()
+                    for future in futures:
+                        future.cancel()
+
+            if layer is None:
+                self.layer = None
+                return True
+            self._save_geopackage(layer, layer_schema, geom_field)
+            return True
+        except RequestCanceled:
+            return False
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+    def _tile_rows(self, tile):
+        where = f"({self.where}) AND {self.predicate.for_rectangle(tile)}"
+        batch_size = 100
+        offset = 0
+        schema = []
+        rows = []
+        while not (self.isCanceled() or self._stop_tiles.is_set()):
+            page_size = batch_size
+            if self.limit:
+                page_size = min(batch_size, self.limit - offset)
+            data = self.get_rows(f"{where} LIMIT {page_size} OFFSET {offset}")
+            page_rows = data.get("rows", [])
+            schema = data.get("schema", schema)
+            rows.extend(page_rows)
+            offset += len(page_rows)
+            if len(page_rows) < page_size or (self.limit and offset >= self.limit):
+                break
+        return schema, rows
+
+    def _write_features(self, provider, features):
+        with INSTRUMENTATION.span("feature_write", features=len(features)):
+            provider.addFeatures(features)
+        INSTRUMENTATION.count("rows", len(features))
+
+    def _create_memory_layer(self, schema, rows):
+        fields, geom_field = fields_from_schema(schema)
+        provider_type = self.table.schema.database.connection.provider_type
+        geom_type = geometry_type_from_rows(rows, geom_field, provider_type)
+        layer = QgsVectorLayer(f"{geom_type}?crs=EPSG:4326", self.table.name, "memory")
+        layer.dataProvider().addAttributes(fields)
+        layer.updateFields()
+        layer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
+        return layer, fields, geom_field
+
+    def _save_geopackage(self, layer, schema, geom_field):
+        geopackage_file = filepath_for_table(
+            self.table.schema.database.connection.name,
+            self.table.schema.database.databaseid,
+            self.table.schema.schemaid,
+            self.table.tableid,
+        )
+        os.makedirs(os.path.dirname(geopackage_file), exist_ok=True)
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
+        options.layerName = layer.name()
+        with INSTRUMENTATION.span("geopackage_flush", features=layer.featureCount()):
             _writer = QgsVectorFileWriter.writeAsVectorFormatV3(
                 layer,
                 geopackage_file,
@@ -255,38 +676,125 @@ class DownloadTableTask(QgsTask):
                 options,
             )
 
-            layer_metadata = {
-                "pk": self.table.pk(),
-                "columns": schema,
-                "geom_column": geom_field,
-                "can_write": self.table.schema.can_write(),
-                "schema_changed": False,
-                "provider_type": self.table.schema.database.connection.provider_type,
-            }
-            gpkglayer = QgsVectorLayer(
-                f"{geopackage_file}|layername={self.table.name}", self.table.name, "ogr"
-            )
-            # gpkglayer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
-            save_layer_metadata(gpkglayer, layer_metadata)
-            self.setProgress(100)
-            self.layer = gpkglayer
+        layer_metadata = {
+            "pk": self.table.pk(),
+            "columns": schema,
+            "geom_column": geom_field,
+            "can_write": self.table.schema.can_write(),
+            "schema_changed": False,
+            "provider_type": self.table.schema.database.connection.provider_type,
+        }
+        if self.tolerance is not None:
+            layer_metadata["lod"] = {"tolerance": self.tolerance}
+        gpkglayer = QgsVectorLayer(
+            f"{geopackage_file}|layername={self.table.name}", self.table.name, "ogr"
+        )
+        # gpkglayer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
+        save_layer_metadata(gpkglayer, layer_metadata)
+        self.setProgress(100)
+        self.layer = gpkglayer
 
-            return True
-        except Exception:
-            self.exception = traceback.format_exc()
-            error(self.exception)
-            return False
+    @contextmanager
+    def _request_scope(self):
+        # Requests of the download may be sent from other threads
+        with request_priority(BULK):
+            with cancellation_scope(self.cancel_token):
+                with task_scope(self.stats):
+                    yield
+
+    def _count_rows(self, count):
+        with self._request_scope():
+            with cancellation_scope(self.count_token):
+                return count()
 
     def get_rows(self, where=None):
         fqn = quote_for_provider(
             f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
             self.table.schema.database.connection.provider_type,
         )
-        return CARTO_API.execute_query(
-            self.table.schema.database.connection.name,
-            f"""SELECT * FROM {fqn}
-                WHERE {where} ;""",
+        with self._request_scope():
+            return CARTO_API.execute_query(
+                self.table.schema.database.connection.name,
+                f"""SELECT {self.select} FROM {fqn}
+                    WHERE {where} ;""",
+            )
+
+    def get_columns(self, where=None):
+        fqn = quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            self.table.schema.database.connection.provider_type,
         )
+        with self._request_scope():
+            return CARTO_API.execute_query_columnar(
+                self.table.schema.database.connection.name,
+                f"""SELECT {self.select} FROM {fqn}
+                    WHERE {where} ;""",
+                geom_column=self.geom_column,
+            )
+
+    def estimated_row_count(self):
+        """
+        Returns the number of rows of the table as stored in the catalog
+        metadata, without scanning the table. Returns None if the provider
+        does not expose it
+        """
+        provider_type = self.table.schema.database.connection.provider_type
+        databaseid = self.table.schema.database.databaseid
+        schemaid = self.table.schema.schemaid
+        tableid = self.table.tableid
+        if provider_type == "bigquery":
+            sql = f"""
+                    SELECT
+                        row_count
+                    FROM
+                        `{databaseid}.{schemaid}.__TABLES__`
+                    WHERE
+                        table_id = '{tableid}';
+                    """
+        elif provider_type == "postgres":
+            sql = f"""
+                    SELECT
+                        reltuples::bigint AS row_count
+                    FROM
+                        pg_class
+                    WHERE
+                        oid = '{databaseid}.{schemaid}.{tableid}'::regclass;
+                    """
+        elif provider_type == "redshift":
+            sql = f"""
+                    SELECT
+                        tbl_rows AS row_count
+                    FROM
+                        svv_table_info
+                    WHERE
+                        "schema" = '{schemaid}'
+                    AND
+                        "table" = '{tableid}';
+                    """
+        elif provider_type == "snowflake":
+            sql = f"""
+                    SELECT
+                        row_count
+                    FROM
+                        {databaseid}.information_schema.tables
+                    WHERE
+                        table_schema = '{schemaid}'
+                    AND
+                        table_name = '{tableid}';
+                    """
+        else:
+            return None
+        rows = CARTO_API.execute_query(
+            self.table.schema.database.connection.name, sql, cache_class="count"
+        )["rows"]
+        if not rows:
+            return None
+        col_name = "ROW_COUNT" if provider_type == "snowflake" else "row_count"
+        row_count = rows[0][col_name]
+        # reltuples is -1 for tables that have never been analyzed
+        if row_count is None or row_count < 0:
+            return None
+        return int(row_count)
 
     def row_count(self):
         fqn = quote_for_provider(
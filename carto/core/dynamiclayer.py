@@ -0,0 +1,592 @@
+import math
+import traceback
+from collections import OrderedDict
+from functools import partial
+
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsProject,
+    QgsRectangle,
+    QgsTask,
+    QgsVectorLayer,
+)
+from qgis.PyQt.QtCore import QObject, QTimer, QVariant
+from qgis.utils import iface
+
+from carto.core.api import CARTO_API
+from carto.core.downloadtabletask import (
+    FeatureBuilder,
+    fields_from_schema,
+    geometry_type_from_rows,
+    row_key,
+)
+from carto.core.cancellation import (
+    CancellationToken,
+    RequestCanceled,
+    cancellation_scope,
+)
+from carto.core.expressions import compile_expression, ExpressionCompileError
+from carto.core.logging import error
+from carto.core.spatialfilter import spatial_predicate_for_table
+from carto.core.utils import (
+    quote_for_provider,
+    quote_column_name_for_provider,
+)
+
+TILE_CACHE_SIZE = 256
+MAX_FEATURES_PER_TILE = 5000
+MAX_TILES_PER_UPDATE = 64
+MAX_TILE_ZOOM = 16
+UPDATE_DELAY_MS = 300
+
+AGGREGATION_FUNCTIONS = ["AVG", "SUM", "MIN", "MAX"]
+# Aggregated values are stored in double fields, so every function needs
+# a numeric column
+NUMERIC_COLUMN_TYPES = ["integer", "int", "bigint", "double", "number", "float"]
+AGGREGATION_DETAIL = 3
+MAX_AGGREGATION_RESOLUTION = 20
+MAX_LATITUDE = 85.05112878
+WEB_MERCATOR_ZOOM0_SCALE = 559082264.028717
+
+WORLD_EXTENT = QgsRectangle(-180, -90, 180, 90)
+
+
+def tile_size(zoom):
+    return 360.0 / (2**zoom)
+
+
+def tile_zoom_for_extent(extent):
+    span = max(extent.width(), extent.height(), 1e-9)
+    zoom = int(math.floor(math.log2(360.0 / span))) + 2
+    return max(0, min(MAX_TILE_ZOOM, zoom))
+
+
+def tiles_for_extent(extent, zoom):
+    size = tile_size(zoom)
+    last = 2**zoom - 1
+
+    def _index(value, offset):
+        return max(0, min(last, int(math.floor((value + offset) / size))))
+
+    xmin = _index(max(extent.xMinimum(), -180), 180)
+    xmax = _index(min(extent.xMaximum(), 180), 180)
+    ymin = _index(max(extent.yMinimum(), -90), 90)
+    ymax = _index(min(extent.yMaximum(), 90), 90)
+    return [(zoom, x, y) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+
+def tile_rectangle(tile):
+    zoom, x, y = tile
+    size = tile_size(zoom)
+    return QgsRectangle(
+        x * size - 180,
+        y * size - 90,
+        min((x + 1) * size - 180, 180),
+        min((y + 1) * size - 90, 90),
+    )
+
+
+def visible_extent(canvas):
+    try:
+        transform = QgsCoordinateTransform(
+            canvas.mapSettings().destinationCrs(),
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            QgsProject.instance(),
+        )
+        extent = transform.transformBoundingBox(canvas.extent())
+        return extent.intersect(WORLD_EXTENT)
+    except Exception:
+        return QgsRectangle(WORLD_EXTENT)
+
+
+class TileCache:
+    """
+    LRU cache of loaded tiles. Each entry stores the keys of the
+    features that were fetched for that tile
+    """
+
+    def __init__(self, max_tiles):
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+
+    def __contains__(self, tile):
+        return tile in self._tiles
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def touch(self, tile):
+        if tile in self._tiles:
+            self._tiles.move_to_end(tile)
+
+    def put(self, tile, keys):
+        """
+        Adds a tile and returns the list of (tile, keys) entries that
+        were evicted to keep the cache within its size
+        """
+        self._tiles[tile] = keys
+        self._tiles.move_to_end(tile)
+        evicted = []
+        while len(self._tiles) > self.max_tiles:
+            evicted.append(self._tiles.popitem(last=False))
+        return evicted
+
+    def clear(self):
+        self._tiles.clear()
+
+
+class FetchTilesTask(QgsTask):
+    def __init__(self, dynamic_layer, tiles):
+        super().__init__(
+            f"Load visible features of {dynamic_layer.table.name}", QgsTask.CanCancel
+        )
+        self.exception = None
+        self.dynamic_layer = dynamic_layer
+        self.tiles = tiles
+        self.results = {}
+        self.cancel_token = CancellationToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+        super().cancel()
+
+    def run(self):
+        try:
+            with cancellation_scope(self.cancel_token):
+                for i, tile in enumerate(self.tiles):
+                    if self.isCanceled():
+                        return False
+                    self.results[tile] = self.dynamic_layer.fetch_tile(tile)
+                    self.setProgress((i + 1) / len(self.tiles) * 100)
+            return True
+        except RequestCanceled:
+            return False
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+
+class DynamicTableLayer(QObject):
+    """
+    A memory layer that is filled on demand with the features of a
+    table that intersect the current map canvas extent
+    """
+
+    def __init__(self, table, canvas=None):
+        super().__init__()
+        self.table = table
+        self.canvas = canvas or iface.mapCanvas()
+        self.provider_type = table.schema.database.connection.provider_type
+        self.connection_name = table.schema.database.connection.name
+        self.pk = table.pk()
+        self.cache = TileCache(TILE_CACHE_SIZE)
+        self.pending = set()
+        self.features = {}
+        self.tasks = []
+
+        geom_column = table.geom_column()
+        data = table.get_rows(f"{geom_column} IS NOT NULL LIMIT 1")
+        schema = data.get("schema", [])
+        self.fields, self.geom_field = fields_from_schema(schema)
+        self.builder = FeatureBuilder(self.fields, self.geom_field)
+        geom_type = geometry_type_from_rows(
+            data.get("rows", []), self.geom_field, self.provider_type
+        )
+        self.layer = QgsVectorLayer(f"{geom_type}?crs=EPSG:4326", table.name, "memory")
+        self.layer.dataProvider().addAttributes(self.fields)
+        self.layer.updateFields()
+        self.layer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
+        self.layer.setReadOnly(True)
+        self.layer.subsetStringChanged.connect(self._subset_string_changed)
+        self.predicate = spatial_predicate_for_table(table, self.geom_field)
+        self.subset_where = None
+        self.generation = 0
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(UPDATE_DELAY_MS)
+        self.timer.timeout.connect(self.update)
+        self.canvas.extentsChanged.connect(self.timer.start)
+
+    def fqn(self):
+        return quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            self.provider_type,
+        )
+
+    def tile_where(self, tile):
+        where = self.predicate.for_rectangle(tile_rectangle(tile))
+        if self.subset_where is not None:
+            where = f"{where} AND {self.subset_where}"
+        return where
+
+    def _subset_string_changed(self):
+        # The subset string is always applied locally by the memory
+        # provider. If it can be translated to SQL, it is also sent to
+        # the server, so features that would be filtered out locally are
+        # never downloaded
+        subset = self.layer.subsetString()
+        try:
+            subset_where = (
+                compile_expression(subset, self.provider_type) if subset else None
+            )
+        except ExpressionCompileError:
+            subset_where = None
+        if subset_where == self.subset_where:
+            return
+        self.subset_where = subset_where
+        self.reload()
+
+    def reload(self):
+        self.generation += 1
+        for task in self.tasks:
+            task.cancel()
+        self.pending.clear()
+        self.cache.clear()
+        self.features = {}
+        self.layer.dataProvider().truncate()
+        self.update()
+
+    def fetch_tile(self, tile):
+        # Features are built while the rows are still being received
+        rows = CARTO_API.execute_query_stream(
+            self.connection_name,
+            f"""SELECT * FROM {self.fqn()}
+                WHERE {self.tile_where(tile)}
+                LIMIT {MAX_FEATURES_PER_TILE} ;""",
+        )
+        return [(row_key(row, self.pk), self.builder.feature(row)) for row in rows]
+
+    def update(self):
+        if self.layer is None:
+            return
+        extent = visible_extent(self.canvas)
+        if extent.isEmpty():
+            return
+        tiles = tiles_for_extent(extent, tile_zoom_for_extent(extent))
+        tiles = tiles[:MAX_TILES_PER_UPDATE]
+        for tile in tiles:
+            self.cache.touch(tile)
+        missing = [t for t in tiles if t not in self.cache and t not in self.pending]
+        if not missing:
+            return
+
+        task = FetchTilesTask(self, missing)
+        task.generation = self.generation
+        self.pending.update(missing)
+        task.taskCompleted.connect(partial(self._tiles_loaded, task))
+        task.taskTerminated.connect(partial(self._tiles_loaded, task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def _tiles_loaded(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        if self.layer is None or task.generation != self.generation:
+            return
+        self.pending.difference_update(task.tiles)
+
+        to_add = OrderedDict()
+        evicted = []
+        for tile, items in task.results.items():
+            keys = []
+            for key, feature in items:
+                keys.append(key)
+                if key in self.features:
+                    self.features[key][1] += 1
+                elif key in to_add:
+                    to_add[key][1] += 1
+                else:
+                    to_add[key] = [feature, 1]
+            evicted.extend(self.cache.put(tile, keys))
+
+        provider = self.layer.dataProvider()
+        if to_add:
+            _, added = provider.addFeatures([f for f, _ in to_add.values()])
+            for (key, (_, count)), feature in zip(to_add.items(), added):
+                self.features[key] = [feature.id(), count]
+
+        to_delete = []
+        for _, keys in evicted:
+            for key in keys:
+                entry = self.features.get(key)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    to_delete.append(entry[0])
+                    del self.features[key]
+        if to_delete:
+            provider.deleteFeatures(to_delete)
+
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+    def stop(self):
+        self.timer.stop()
+        try:
+            self.canvas.extentsChanged.disconnect(self.timer.start)
+        except TypeError:
+            pass
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.cache.clear()
+        self.features = {}
+        self.layer = None
+
+
+class AggregateTask(QgsTask):
+    def __init__(self, aggregated_layer, resolution, extent):
+        super().__init__(
+            f"Aggregate {aggregated_layer.table.name} at resolution {resolution}",
+            QgsTask.CanCancel,
+        )
+        self.exception = None
+        self.aggregated_layer = aggregated_layer
+        self.resolution = resolution
+        self.extent = extent
+        self.rows = []
+        self.cancel_token = CancellationToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+        super().cancel()
+
+    def run(self):
+        try:
+            with cancellation_scope(self.cancel_token):
+                self.rows = self.aggregated_layer.fetch_cells(
+                    self.resolution, self.extent
+                )
+            return not self.isCanceled()
+        except RequestCanceled:
+            return False
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+
+def resolution_for_scale(scale):
+    zoom = math.log2(WEB_MERCATOR_ZOOM0_SCALE / max(scale, 1))
+    return max(0, min(MAX_AGGREGATION_RESOLUTION, int(zoom) + AGGREGATION_DETAIL))
+
+
+def cell_rectangle(resolution, x, y):
+    n = 2**resolution
+
+    def _lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return QgsRectangle(
+        x / n * 360 - 180, _lat(y + 1), (x + 1) / n * 360 - 180, _lat(y)
+    )
+
+
+def point_expression_for_provider(provider_type, geom_column):
+    if provider_type == "databricksRest":
+        return f"ST_CENTROID(ST_GEOMFROMWKB({geom_column}))"
+    elif provider_type in ["postgres", "redshift"]:
+        return f"""(CASE
+                WHEN ST_SRID({geom_column}) = 0 THEN ST_CENTROID({geom_column})
+                ELSE ST_TRANSFORM(ST_CENTROID({geom_column}), 4326)
+            END)"""
+    else:
+        return f"ST_CENTROID({geom_column})"
+
+
+class AggregatedTableLayer(QObject):
+    """
+    A polygon layer with the features of a table aggregated in the data
+    warehouse into quadbin cells (the web map tile grid), at a resolution
+    that follows the scale of the map canvas
+    """
+
+    def __init__(self, table, aggregates, canvas=None):
+        super().__init__()
+        self.table = table
+        self.aggregates = aggregates
+        self.canvas = canvas or iface.mapCanvas()
+        self.provider_type = table.schema.database.connection.provider_type
+        self.connection_name = table.schema.database.connection.name
+        self.geom_column = table.geom_column()
+        self.predicate = spatial_predicate_for_table(table, self.geom_column)
+        self.resolution = None
+        self.loaded_extent = None
+        self.tasks = []
+
+        fields = QgsFields()
+        fields.append(QgsField("resolution", QVariant.Int))
+        fields.append(QgsField("x", QVariant.Int))
+        fields.append(QgsField("y", QVariant.Int))
+        fields.append(QgsField("count", QVariant.LongLong))
+        for column, function in aggregates:
+            fields.append(
+                QgsField(self.aggregate_name(column, function), QVariant.Double)
+            )
+        self.fields = fields
+
+        self.layer = QgsVectorLayer(
+            "Polygon?crs=EPSG:4326", f"{table.name} (aggregated)", "memory"
+        )
+        self.layer.dataProvider().addAttributes(fields)
+        self.layer.updateFields()
+        self.layer.setReadOnly(True)
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(UPDATE_DELAY_MS)
+        self.timer.timeout.connect(self.update)
+        self.canvas.extentsChanged.connect(self.timer.start)
+
+    @staticmethod
+    def aggregate_name(column, function):
+        return f"{function}_{column}".lower()
+
+    def fqn(self):
+        return quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            self.provider_type,
+        )
+
+    def fetch_cells(self, resolution, extent):
+        n = 2**resolution
+        point = point_expression_for_provider(self.provider_type, self.geom_column)
+        where = self.predicate.for_rectangle(extent)
+        values = "".join(
+            f", {quote_column_name_for_provider(column, self.provider_type)} AS value_{i}"
+            for i, (column, _) in enumerate(self.aggregates)
+        )
+        passthrough = "".join(f", value_{i}" for i in range(len(self.aggregates)))
+        aggregates = "".join(
+            f", {function}(value_{i}) AS {self.aggregate_name(column, function)}"
+            for i, (column, function) in enumerate(self.aggregates)
+        )
+        query = f"""
+            SELECT x, y, COUNT(*) AS cell_count{aggregates}
+            FROM (
+                SELECT
+                    FLOOR((lon + 180) / 360 * {n}) AS x,
+                    FLOOR((1 - LN(TAN(lat) + 1 / COS(lat)) / {math.pi}) / 2 * {n}) AS y{passthrough}
+                FROM (
+                    SELECT
+                        ST_X({point}) AS lon,
+                        GREATEST(LEAST(ST_Y({point}), {MAX_LATITUDE}), -{MAX_LATITUDE}) * {math.pi} / 180 AS lat{values}
+                    FROM {self.fqn()}
+                    WHERE {where}
+                ) points
+            ) cells
+            GROUP BY x, y ;"""
+        return CARTO_API.execute_query(self.connection_name, query).get("rows", [])
+
+    def update(self):
+        if self.layer is None:
+            return
+        extent = visible_extent(self.canvas)
+        if extent.isEmpty():
+            return
+        resolution = resolution_for_scale(self.canvas.scale())
+        if (
+            resolution == self.resolution
+            and self.loaded_extent is not None
+            and self.loaded_extent.contains(extent)
+        ):
+            return
+        extent.scale(1.5)
+        extent = extent.intersect(WORLD_EXTENT)
+        for task in self.tasks:
+            task.cancel()
+        task = AggregateTask(self, resolution, extent)
+        task.taskCompleted.connect(partial(self._cells_loaded, task))
+        task.taskTerminated.connect(partial(self._cells_loaded, task))
+        self.tasks.append(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def _cells_loaded(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        # Failed tasks leave the cells loaded so far, and the next update
+        # of the canvas tries again
+        if self.layer is None or task.isCanceled() or task.exception is not None:
+            return
+        features = []
+        for row in task.rows:
+            # Snowflake returns unquoted identifiers in upper case
+            row = {k.lower(): v for k, v in row.items()}
+            x = int(row["x"])
+            y = int(row["y"])
+            feature = QgsFeature(self.fields)
+            attributes = [task.resolution, x, y, row["cell_count"]]
+            for column, function in self.aggregates:
+                attributes.append(row.get(self.aggregate_name(column, function)))
+            feature.setAttributes(attributes)
+            feature.setGeometry(
+                QgsGeometry.fromRect(cell_rectangle(task.resolution, x, y))
+            )
+            features.append(feature)
+        provider = self.layer.dataProvider()
+        provider.truncate()
+        provider.addFeatures(features)
+        self.resolution = task.resolution
+        self.loaded_extent = task.extent
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+    def stop(self):
+        self.timer.stop()
+        try:
+            self.canvas.extentsChanged.disconnect(self.timer.start)
+        except TypeError:
+            pass
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.layer = None
+
+
+_dynamic_layers = {}
+
+
+def _layers_removed(layerids):
+    for layerid in layerids:
+        dynamic_layer = _dynamic_layers.pop(layerid, None)
+        if dynamic_layer is not None:
+            dynamic_layer.stop()
+    if not _dynamic_layers:
+        QgsProject.instance().layersWillBeRemoved.disconnect(_layers_removed)
+
+
+def _register(dynamic_layer):
+    if not _dynamic_layers:
+        QgsProject.instance().layersWillBeRemoved.connect(_layers_removed)
+    _dynamic_layers[dynamic_layer.layer.id()] = dynamic_layer
+    QgsProject.instance().addMapLayer(dynamic_layer.layer)
+    dynamic_layer.update()
+
+
+def add_dynamic_layer(table):
+    dynamic_layer = DynamicTableLayer(table)
+    if dynamic_layer.geom_field is None:
+        iface.messageBar().pushMessage(
+            f"Table {table.name} has no geometry column",
+            level=Qgis.Warning,
+            duration=5,
+        )
+        return None
+    _register(dynamic_layer)
+    return dynamic_layer
+
+
+def add_aggregated_layer(table, aggregates):
+    aggregated_layer = AggregatedTableLayer(table, aggregates)
+    _register(aggregated_layer)
+    return aggregated_layer
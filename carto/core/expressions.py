@@ -0,0 +1,229 @@
+import math
+
+from qgis.core import (
+    NULL,
+    QgsExpression,
+    QgsExpressionNode,
+    QgsExpressionNodeBinaryOperator,
+    QgsExpressionNodeUnaryOperator,
+)
+
+from carto.core.utils import quote_column_name_for_provider
+
+
+class ExpressionCompileError(Exception):
+    pass
+
+
+BINARY_OPERATORS = {
+    QgsExpressionNodeBinaryOperator.boOr: "OR",
+    QgsExpressionNodeBinaryOperator.boAnd: "AND",
+    QgsExpressionNodeBinaryOperator.boEQ: "=",
+    QgsExpressionNodeBinaryOperator.boNE: "<>",
+    QgsExpressionNodeBinaryOperator.boLE: "<=",
+    QgsExpressionNodeBinaryOperator.boGE: ">=",
+    QgsExpressionNodeBinaryOperator.boLT: "<",
+    QgsExpressionNodeBinaryOperator.boGT: ">",
+    QgsExpressionNodeBinaryOperator.boLike: "LIKE",
+    QgsExpressionNodeBinaryOperator.boNotLike: "NOT LIKE",
+    QgsExpressionNodeBinaryOperator.boMinus: "-",
+    QgsExpressionNodeBinaryOperator.boMul: "*",
+}
+
+UNARY_OPERATORS = {
+    QgsExpressionNodeUnaryOperator.uoNot: "NOT",
+    QgsExpressionNodeUnaryOperator.uoMinus: "-",
+}
+
+# QGIS function name -> (SQL function name, allowed number of arguments)
+FUNCTIONS = {
+    "lower": ("LOWER", [1]),
+    "upper": ("UPPER", [1]),
+    "length": ("LENGTH", [1]),
+    "trim": ("TRIM", [1]),
+    "substr": ("SUBSTR", [2, 3]),
+    "abs": ("ABS", [1]),
+    "round": ("ROUND", [1, 2]),
+    "floor": ("FLOOR", [1]),
+    "ceil": ("CEIL", [1]),
+    "sqrt": ("SQRT", [1]),
+    "coalesce": ("COALESCE", None),
+}
+
+
+class ExpressionCompiler:
+    """
+    Translates a QGIS expression into an equivalent SQL boolean
+    expression for a provider, so it can be evaluated by the data
+    warehouse. Raises ExpressionCompileError if the expression uses
+    something that has no direct SQL equivalent
+    """
+
+    def __init__(self, provider_type):
+        self.provider_type = provider_type
+
+    def compile(self, expression):
+        if not isinstance(expression, QgsExpression):
+            expression = QgsExpression(expression)
+        if expression.hasParserError():
+            raise ExpressionCompileError(expression.parserErrorString())
+        if expression.rootNode() is None:
+            raise ExpressionCompileError("Empty expression")
+        return self._compile(expression.rootNode())
+
+    def _compile(self, node):
+        node_type = node.nodeType()
+        if node_type == QgsExpressionNode.ntLiteral:
+            return self.literal(node.value())
+        elif node_type == QgsExpressionNode.ntColumnRef:
+            return quote_column_name_for_provider(node.name(), self.provider_type)
+        elif node_type == QgsExpressionNode.ntUnaryOperator:
+            operator = UNARY_OPERATORS.get(node.op())
+            if operator is None:
+                raise ExpressionCompileError(f"Unsupported operator: {node.text()}")
+            return f"({operator} {self._compile(node.operand())})"
+        elif node_type == QgsExpressionNode.ntBinaryOperator:
+            return self._binary_operator(node)
+        elif node_type == QgsExpressionNode.ntInOperator:
+            values = ", ".join(self._compile(n) for n in node.list().list())
+            operator = "NOT IN" if node.isNotIn() else "IN"
+            return f"({self._compile(node.node())} {operator} ({values}))"
+        elif node_type == QgsExpressionNode.ntFunction:
+            return self._function(node)
+        elif node_type == QgsExpressionNode.ntCondition:
+            whens = " ".join(
+                f"WHEN {self._compile(c.whenExp())} THEN {self._compile(c.thenExp())}"
+                for c in node.conditions()
+            )
+            if node.elseExp() is not None:
+                whens += f" ELSE {self._compile(node.elseExp())}"
+            return f"(CASE {whens} END)"
+        elif node_type == getattr(QgsExpressionNode, "ntBetweenOperator", None):
+            operator = "NOT BETWEEN" if node.isNotBetween() else "BETWEEN"
+            return (
+                f"({self._compile(node.node())} {operator} "
+                f"{self._compile(node.lowerBound())} AND {self._compile(node.higherBound())})"
+            )
+        raise ExpressionCompileError(f"Unsupported expression: {node.dump()}")
+
+    def literal(self, value):
+        if value is None or value == NULL:
+            return "NULL"
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ExpressionCompileError(f"Unsupported literal: {value!r}")
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, str):
+            if self.provider_type in ["bigquery", "databricksRest"]:
+                escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+            else:
+                escaped = value.replace("'", "''")
+            return f"'{escaped}'"
+        raise ExpressionCompileError(f"Unsupported literal: {value!r}")
+
+    def _binary_operator(self, node):
+        left = self._compile(node.opLeft())
+        right = self._compile(node.opRight())
+        op = node.op()
+        if op in BINARY_OPERATORS:
+            return f"({left} {BINARY_OPERATORS[op]} {right})"
+        elif op in [
+            QgsExpressionNodeBinaryOperator.boIs,
+            QgsExpressionNodeBinaryOperator.boIsNot,
+        ]:
+            return self._is_operator(node, left, right)
+        elif op == QgsExpressionNodeBinaryOperator.boPlus:
+            # QGIS concatenates strings with +, but the type of columns is
+            # not known here, so only literals can be told apart
+            left_string = _is_string_literal(node.opLeft())
+            right_string = _is_string_literal(node.opRight())
+            if left_string and right_string:
+                return self._concat(left, right)
+            elif left_string or right_string:
+                raise ExpressionCompileError(
+                    f"Ambiguous addition of a string: {node.text()}"
+                )
+            return f"({left} + {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boDiv:
+            # QGIS always uses floating point division
+            if self.provider_type in ["postgres", "redshift"]:
+                return f"(CAST({left} AS DOUBLE PRECISION) / {right})"
+            return f"({left} / {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boIntDiv:
+            if self.provider_type in ["postgres", "redshift"]:
+                # Integer division truncates towards zero there
+                return f"FLOOR(CAST({left} AS DOUBLE PRECISION) / {right})"
+            return f"FLOOR({left} / {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boMod:
+            return f"MOD({left}, {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boPow:
+            return f"POWER({left}, {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boConcat:
+            return self._concat(left, right)
+        elif op in [
+            QgsExpressionNodeBinaryOperator.boILike,
+            QgsExpressionNodeBinaryOperator.boNotILike,
+        ]:
+            negate = "NOT " if op == QgsExpressionNodeBinaryOperator.boNotILike else ""
+            if self.provider_type == "bigquery":
+                return f"({negate}LOWER({left}) LIKE LOWER({right}))"
+            return f"({left} {negate}ILIKE {right})"
+        elif op == QgsExpressionNodeBinaryOperator.boRegexp:
+            if self.provider_type == "bigquery":
+                return f"REGEXP_CONTAINS({left}, {right})"
+            elif self.provider_type == "snowflake":
+                return f"REGEXP_LIKE({left}, CONCAT('.*', {right}, '.*'))"
+            elif self.provider_type == "databricksRest":
+                return f"({left} RLIKE {right})"
+            return f"({left} ~ {right})"
+        raise ExpressionCompileError(f"Unsupported operator: {node.text()}")
+
+    def _concat(self, left, right):
+        # QGIS returns NULL when an operand is NULL, like the || operator
+        # does, while CONCAT ignores NULL operands in PostgreSQL
+        if self.provider_type in ["postgres", "redshift"]:
+            return f"({left} || {right})"
+        return f"CONCAT({left}, {right})"
+
+    def _is_operator(self, node, left, right):
+        negate = node.op() == QgsExpressionNodeBinaryOperator.boIsNot
+        if _is_null_literal(node.opLeft()):
+            left, right = right, left
+        if _is_null_literal(node.opLeft()) or _is_null_literal(node.opRight()):
+            return f"({left} {'IS NOT' if negate else 'IS'} {right})"
+        # Otherwise QGIS compares the values, treating NULLs as equal
+        if self.provider_type == "redshift":
+            equal = f"COALESCE({left} = {right}, {left} IS NULL AND {right} IS NULL)"
+            return f"(NOT {equal})" if negate else equal
+        operator = "IS DISTINCT FROM" if negate else "IS NOT DISTINCT FROM"
+        return f"({left} {operator} {right})"
+
+    def _function(self, node):
+        name = QgsExpression.Functions()[node.fnIndex()].name().lower()
+        if name not in FUNCTIONS:
+            raise ExpressionCompileError(f"Unsupported function: {name}")
+        sql_name, arg_counts = FUNCTIONS[name]
+        args = node.args().list() if node.args() is not None else []
+        if arg_counts is not None and len(args) not in arg_counts:
+            raise ExpressionCompileError(
+                f"Unsupported number of arguments for function: {name}"
+            )
+        return f"{sql_name}({', '.join(self._compile(a) for a in args)})"
+
+
+def _is_literal(node):
+    return node.nodeType() == QgsExpressionNode.ntLiteral
+
+
+def _is_null_literal(node):
+    return _is_literal(node) and (node.value() is None or node.value() == NULL)
+
+
+def _is_string_literal(node):
+    return _is_literal(node) and isinstance(node.value(), str)
+
+
+def compile_expression(expression, provider_type):
+    return ExpressionCompiler(provider_type).compile(expression)
@@ -8,12 +8,23 @@ from carto.core.utils import (
     provider_data_type_from_qgis_type,
     quote_for_provider,
     prepare_geo_value_for_provider,
-    prepare_multipart_sql,
+    max_statement_size,
+    split_statements,
 )
 from carto.core.api import CARTO_API
+from carto.core.cache import QUERY_CACHE
+from carto.core.scheduler import request_priority, BULK
+from carto.core.instrumentation import INSTRUMENTATION, task_scope
+from carto.core.cancellation import (
+    CancellationToken,
+    RequestCanceled,
+    cancellation_scope,
+)
 
 from qgis.PyQt.QtCore import QVariant
 
+MAX_STATEMENTS_PER_BATCH = 1000
+
 
 class ImportLayerTask(QgsTask):
     def __init__(
@@ -29,8 +40,23 @@ class ImportLayerTask(QgsTask):
         self.layer = layer
         self.connection_name = connection_name
         self.provider_type = provider_type
+        self.cancel_token = CancellationToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+        super().cancel()
 
     def run(self):
+        stats = INSTRUMENTATION.start_task(self.description())
+        try:
+            with request_priority(BULK):
+                with cancellation_scope(self.cancel_token):
+                    with task_scope(stats):
+                        return self._import()
+        finally:
+            INSTRUMENTATION.finish_task(stats)
+
+    def _import(self):
         try:
             self.setProgress(0)
             fqn = quote_for_provider(self.fqn, self.provider_type)
@@ -50,9 +76,9 @@ class ImportLayerTask(QgsTask):
                 DROP TABLE IF EXISTS {self.fqn};
                 {sql_create}
                 """
-            sql_create = prepare_multipart_sql([sql_create], self.provider_type, fqn)
-            for statement in sql_create:
-                CARTO_API.execute_query(self.connection_name, statement)
+            CARTO_API.execute_statements(
+                self.connection_name, self.provider_type, fqn, [sql_create]
+            )
             self.setProgress(1)
             insert_statements = []
 
@@ -84,34 +110,31 @@ class ImportLayerTask(QgsTask):
                 )
                 insert_statements.append(insert_statement)
 
-            batch_size = 10
-            num_batches = len(insert_statements) // batch_size
-            for i in range(num_batches):
+            # Batches are as large as the provider allows, but limited in
+            # number of rows so progress is still reported regularly
+            batches = list(
+                split_statements(
+                    insert_statements,
+                    max_statement_size(self.provider_type),
+                    MAX_STATEMENTS_PER_BATCH,
+                )
+            )
+            for i, batch in enumerate(batches):
                 if self.isCanceled():
                     return False
-                sql = prepare_multipart_sql(
-                    insert_statements[i * batch_size : (i + 1) * batch_size],
-                    self.provider_type,
-                    self.fqn,
-                )
-                for statement in sql:
-                    CARTO_API.execute_query_post(
-                        self.connection_name,
-                        statement,
-                    )
-                self.setProgress(int(i / num_batches * 100))
-            if (num_batches * batch_size) < len(insert_statements):
-                sql = prepare_multipart_sql(
-                    insert_statements[num_batches * batch_size :],
-                    self.provider_type,
-                    self.fqn,
-                )
-                for statement in sql:
-                    CARTO_API.execute_query_post(
-                        self.connection_name,
-                        statement,
+                with INSTRUMENTATION.span("insert_batch", rows=len(batch)):
+                    CARTO_API.execute_statements(
+                        self.connection_name, self.provider_type, self.fqn, batch
                     )
+                INSTRUMENTATION.count("rows", len(batch))
+                self.setProgress(int((i + 1) / len(batches) * 100))
             return True
+        except RequestCanceled:
+            return False
         except Exception:
             self.exception = traceback.format_exc()
             return False
+        finally:
+            # Cached results of this connection may no longer be valid,
+            # even if the import failed halfway
+            QUERY_CACHE.invalidate(self.connection_name)
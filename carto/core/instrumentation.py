@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+from carto.core.logging import info
+
+# Maximum number of spans kept for trace export
+MAX_TRACE_EVENTS = 100000
+
+# Queries that take longer than this number of seconds to return their
+# first byte are kept in the list of slow queries
+SLOW_QUERY_SECONDS = 5
+MAX_SLOW_QUERIES = 50
+
+_local = threading.local()
+
+
+class TaskStats:
+    """
+    Times and counters of the work done by a task, including the work
+    done by other threads on its behalf
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.times[name] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.times), dict(self.counts)
+
+    def summary(self):
+        times, counts = self.snapshot()
+        lines = [f"{self.name}: {self.elapsed():.2f}s"]
+        for name, seconds in sorted(times.items(), key=lambda t: -t[1]):
+            line = f"  {name}: {seconds:.2f}s"
+            if counts.get(name):
+                line += f" ({counts[name]} times)"
+            lines.append(line)
+        for name in ["rows", "bytes_in", "bytes_out"]:
+            if counts.get(name):
+                lines.append(f"  {name}: {counts[name]}")
+        return "\n".join(lines)
+
+
+def current_task_stats():
+    return getattr(_local, "stats", None)
+
+
+@contextmanager
+def task_scope(stats):
+    """
+    Attributes the spans and counters recorded by the current thread to
+    the given task
+    """
+    previous = getattr(_local, "stats", None)
+    _local.stats = stats
+    try:
+        yield
+    finally:
+        _local.stats = previous
+
+
+class Instrumentation:
+    """
+    Records spans of the work done by the plugin (requests, decoding,
+    writing...), attributes their time to the running tasks and keeps
+    them so they can be exported as a Chrome trace file
+    """
+
+    def __init__(self):
+        self.events = deque(maxlen=MAX_TRACE_EVENTS)
+        self.tasks = []
+        self.counters = defaultdict(int)
+        self.slow_queries = deque(maxlen=MAX_SLOW_QUERIES)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(name, start, time.perf_counter() - start, args)
+
+    def record(self, name, start, duration, args=None):
+        stats = current_task_stats()
+        if stats is not None:
+            stats.add_time(name, duration)
+            stats.count(name)
+        event = {
+            "name": name,
+            "cat": stats.name if stats is not None else "carto",
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def count(self, name, n=1):
+        stats = current_task_stats()
+        if stats is not None:
+            stats.count(name, n)
+
+    def add_time(self, name, seconds):
+        # For work spread over many short calls, which would flood the
+        # trace if each of them was a span
+        stats = current_task_stats()
+        if stats is not None:
+            stats.add_time(name, seconds)
+
+    def increment(self, name, n=1):
+        """
+        Increments a counter that is not related to any task, such as
+        cache hits and misses
+        """
+        with self._lock:
+            self.counters[name] += n
+
+    def hit_ratio(self, name):
+        with self._lock:
+            hits = self.counters[f"{name}_hit"]
+            misses = self.counters[f"{name}_miss"]
+        if hits + misses == 0:
+            return None
+        return hits / (hits + misses)
+
+    def record_query(self, connection, query, seconds):
+        if seconds < SLOW_QUERY_SECONDS:
+            return
+        # Comments, such as the one used to bust caches, are left out
+        text = " ".join(
+            line.strip()
+            for line in query.splitlines()
+            if not line.strip().startswith("--")
+        )
+        self.slow_queries.append(
+            {
+                "time": time.time(),
+                "connection": connection,
+                "seconds": seconds,
+                "query": text,
+            }
+        )
+
+    def start_task(self, name):
+        stats = TaskStats(name)
+        with self._lock:
+            self.tasks.append(stats)
+        return stats
+
+    def finish_task(self, stats):
+        stats.finished = time.time()
+        with self._lock:
+            if stats in self.tasks:
+                self.tasks.remove(stats)
+        info(stats.summary())
+
+    def running_tasks(self):
+        with self._lock:
+            return list(self.tasks)
+
+    def export_chrome_trace(self, filename):
+        events = list(self.events)
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+INSTRUMENTATION = Instrumentation()
@@ -0,0 +1,111 @@
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+
+
+class JsonRowStream:
+    """
+    Decodes a SQL API JSON response while it is being received. Rows of
+    the "rows" array are yielded one by one as soon as they are complete,
+    so the whole body and the full list of rows are never held in memory
+    at once. The remaining top level values (schema, metadata...) are
+    stored in the values dict when they are found
+    """
+
+    def __init__(self, chunks, rows_key="rows"):
+        self.rows_key = rows_key
+        self.values = {}
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+
+    @property
+    def schema(self):
+        return self.values.get("schema", [])
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == self.rows_key:
+                yield from self._rows()
+            else:
+                self.values[key] = self._value()
+            if self._next_delimiter("}") == "}":
+                return
+
+    def _rows(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._next_delimiter("]") == "]":
+                return
+
+    def _read(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._buffer += self._decoder.decode(b"", final=True)
+            self._exhausted = True
+            return False
+        # Drop the part of the buffer that has already been decoded
+        self._buffer = self._buffer[self._pos :] + self._decoder.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while (
+                self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE
+            ):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return
+            if not self._read():
+                raise ValueError("Unexpected end of JSON response")
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self._buffer[self._pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(
+                f"Expected '{char}' at position {self._pos} of JSON response"
+            )
+        self._pos += 1
+
+    def _next_delimiter(self, closing):
+        char = self._peek()
+        if char not in (",", closing):
+            raise ValueError(f"Unexpected '{char}' in JSON response")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # A number at the end of the buffer might continue in the
+                # next chunk
+                if end < len(self._buffer) or self._exhausted:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+            self._read()
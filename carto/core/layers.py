@@ -17,11 +17,11 @@ from qgis.core import (
 )
 
 from carto.core.api import CARTO_API
+from carto.core.cache import QUERY_CACHE
 from carto.core.logging import error
 from carto.core.utils import (
     quote_for_provider,
     quote_column_name_for_provider,
-    prepare_multipart_sql,
     prepare_geo_value_for_provider,
     prepare_attribute_string,
 )
@@ -72,6 +72,8 @@ class LayerTracker:
     def layer_added(self, layer):
         if isinstance(layer, QgsVectorLayer):
             if is_carto_layer(layer):
+                if is_simplified(layer):
+                    layer.setReadOnly(True)
                 upload_changes_func = partial(self.upload_changes, layer)
                 layer.afterCommitChanges.connect(upload_changes_func)
                 before_commit_func = partial(self._on_editing_started, layer)
@@ -131,6 +133,14 @@ class LayerTracker:
 
         metadata = layer_metadata(layer)
 
+        if metadata.get("lod"):
+            iface.messageBar().pushMessage(
+                "Layer geometries are simplified: changes will not be uploaded upstream",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            return
+
         if self.layer_changes[layer.id()].schema_has_changed:
             metadata["schema_changed"] = True
             save_layer_metadata(layer, metadata)
@@ -247,9 +257,7 @@ class LayerTracker:
                 )
         connection = connection_from_layer(layer)
         try:
-            sql = prepare_multipart_sql(statements, provider_type, fqn)
-            for statement in sql:
-                CARTO_API.execute_query(connection, statement)
+            CARTO_API.execute_statements(connection, provider_type, fqn, statements)
             iface.messageBar().pushMessage(
                 "Layer changes uploaded", level=Qgis.Success, duration=5
             )
@@ -260,6 +268,8 @@ class LayerTracker:
                 duration=5,
             )
             error("Error uploading changes: " + str(e))
+        finally:
+            QUERY_CACHE.invalidate(connection)
 
     def disconnect_layer(self, layer):
         for f in self.connected[layer.id()]:
@@ -323,6 +333,11 @@ def was_schema_changed(layer):
     return metadata["schema_changed"]
 
 
+def is_simplified(layer):
+    metadata = layer_metadata(layer)
+    return metadata.get("lod") is not None
+
+
 def pk_from_layer(layer):
     metadata = layer_metadata(layer)
     return metadata["pk"]
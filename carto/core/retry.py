@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+
+from carto.core.cancellation import RequestCanceled
+
+MAX_RETRIES = 5
+BASE_DELAY = 1
+MAX_DELAY = 60
+
+# Sustained number of requests per second for a single connection, and
+# number of requests that can be sent at once after an idle period
+REQUESTS_PER_SECOND = 10
+BURST_SIZE = 20
+
+# Responses that mean the request was not processed, so sending it again
+# is safe even if it modifies data
+THROTTLED_STATUS_CODES = [429, 503]
+# Responses that may be transient, but for which the request might have
+# been processed, so only idempotent requests are retried
+TRANSIENT_STATUS_CODES = [500, 502, 504]
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+class TokenBucket:
+    """
+    Limits the rate of requests sent to a connection. Each request takes a
+    token, and tokens are refilled at a constant rate up to the size of
+    the bucket. When the server reports throttling, the bucket is paused
+    so all threads using the connection back off together
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST_SIZE):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, token=None):
+        """
+        Waits until a request can be sent. If a cancellation token is
+        given, the wait ends with RequestCanceled as soon as it is canceled,
+        even during a pause requested by the server
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if token is None:
+                time.sleep(wait)
+            elif token.wait(wait):
+                raise RequestCanceled()
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def token_bucket(key):
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket()
+        return _buckets[key]
+
+
+def is_retryable(method, response=None, exception=None):
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    if exception is not None:
+        # A request that could not connect was never received
+        if isinstance(exception, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(exception, requests.exceptions.ConnectionError):
+            return idempotent
+        # A read timeout means the query is slow, and sending it again
+        # would only make the user wait longer
+        return False
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return True
+    return idempotent and response.status_code in TRANSIENT_STATUS_CODES
+
+
+def retry_after(response):
+    """
+    Returns the number of seconds to wait requested by the server in the
+    Retry-After header, or None if it is missing or invalid. The wait is
+    capped to MAX_DELAY, since it pauses every request to the connection
+    """
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        seconds = (date - datetime.now(timezone.utc)).total_seconds()
+    return min(MAX_DELAY, max(0, seconds))
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter, so threads and clients that
+    # failed at the same time do not retry at the same time
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+from carto.core.cancellation import RequestCanceled
+
+# Priority classes, from most to least urgent
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BULK: "bulk"}
+
+# Maximum number of requests sent at once to a single connection
+MAX_CONCURRENT_REQUESTS = 6
+
+# Number of slots of each connection that lower priority requests can not
+# use, so browsing stays responsive while large transfers are running
+RESERVED_SLOTS = {INTERACTIVE: 0, NORMAL: 1, BULK: 2}
+
+# Seconds between checks of the cancellation token of waiting requests
+CANCEL_POLL_INTERVAL = 0.2
+
+_local = threading.local()
+
+
+def current_priority():
+    """
+    Returns the priority set for the current thread. Requests made from
+    the main thread are interactive by default, since the user is waiting
+    for them, while those made from other threads are normal
+    """
+    priority = getattr(_local, "priority", None)
+    if priority is not None:
+        return priority
+    if threading.current_thread() is threading.main_thread():
+        return INTERACTIVE
+    return NORMAL
+
+
+@contextmanager
+def request_priority(priority):
+    previous = getattr(_local, "priority", None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class RequestScheduler:
+    """
+    Limits the number of requests running at once for each connection.
+    Waiting requests are started in order of priority, and then in order
+    of arrival
+    """
+
+    def __init__(self, budget=MAX_CONCURRENT_REQUESTS):
+        self.budget = budget
+        self._condition = threading.Condition()
+        self._running = {}
+        self._waiting = {}
+        self._counter = itertools.count()
+
+    def limit(self, priority):
+        return max(1, self.budget - RESERVED_SLOTS[priority])
+
+    @contextmanager
+    def slot(self, key, priority=None, token=None):
+        if priority is None:
+            priority = current_priority()
+        entry = (priority, next(self._counter))
+        with self._condition:
+            waiting = self._waiting.setdefault(key, [])
+            heapq.heappush(waiting, entry)
+            # Only the most urgent waiting request can start. Requests with
+            # lower priority have a lower limit, so they could not start
+            # either
+            while not (
+                waiting[0] == entry and self._running.get(key, 0) < self.limit(priority)
+            ):
+                if token is not None and token.is_canceled():
+                    waiting.remove(entry)
+                    heapq.heapify(waiting)
+                    self._condition.notify_all()
+                    raise RequestCanceled()
+                self._condition.wait(CANCEL_POLL_INTERVAL)
+            heapq.heappop(waiting)
+            self._running[key] = self._running.get(key, 0) + 1
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def hold(self, key):
+        """
+        Counts a request that keeps running after its slot was released,
+        such as one abandoned when its task was canceled, so the number of
+        requests in flight still matches the open connections
+        """
+        with self._condition:
+            self._running[key] = self._running.get(key, 0) + 1
+
+    def release(self, key):
+        with self._condition:
+            self._running[key] -= 1
+            self._condition.notify_all()
+
+    def in_flight(self):
+        with self._condition:
+            return {key: n for key, n in self._running.items() if n}
+
+    def queued(self):
+        with self._condition:
+            return {key: len(w) for key, w in self._waiting.items() if w}
+
+
+SCHEDULER = RequestScheduler()
@@ -0,0 +1,65 @@
+import copy
+import threading
+
+from carto.core.cancellation import RequestCanceled
+from carto.core.scheduler import current_priority
+
+
+class _Call:
+    def __init__(self, priority):
+        self.done = threading.Event()
+        self.priority = priority
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """
+    Runs only one call at a time for each key. Callers that ask for a key
+    while a call for it is in flight wait for it and get a copy of its
+    result (or its exception) instead of starting a new one
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, allow_bypass=False):
+        """
+        Runs func, or waits for the call for the same key that is already
+        in flight. With allow_bypass, a caller more urgent than the one
+        running the call does not wait for it and runs func itself, so it
+        must only be used when running func twice at once is harmless
+        """
+        priority = current_priority()
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call(priority)
+            if leader:
+                break
+            if allow_bypass and priority < call.priority:
+                # Waiting would make a more urgent caller queue behind the
+                # requests of a less urgent one
+                return func()
+            call.done.wait()
+            if isinstance(call.exception, RequestCanceled):
+                # Only the task of the leader was canceled, so the call is
+                # made again on behalf of the callers that were waiting
+                continue
+            if call.exception is not None:
+                raise call.exception
+            # Each caller gets its own copy, so it can modify it freely
+            return copy.deepcopy(call.result)
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
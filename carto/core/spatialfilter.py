@@ -0,0 +1,158 @@
+import threading
+
+from qgis.core import QgsGeometry
+
+from carto.core.api import CARTO_API
+from carto.core.utils import quote_for_provider
+
+# Number of segments per side used when an envelope is reprojected, so
+# that its edges follow the curvature of the original lat/lon rectangle
+ENVELOPE_SEGMENTS = 32
+
+# Polygons used as filters are simplified until they have at most this
+# number of vertices, to keep the SQL statement small
+MAX_FILTER_VERTICES = 500
+WKT_PRECISION = 6
+
+
+def simplify_filter_polygon(geometry, max_vertices=MAX_FILTER_VERTICES):
+    """
+    Reduces the number of vertices of a polygon used as spatial filter.
+    The polygon is buffered by the simplification tolerance first, so the
+    result still covers the original area and no feature is left out
+    """
+    if geometry.constGet().nCoordinates() <= max_vertices:
+        return geometry
+    bbox = geometry.boundingBox()
+    tolerance = max(bbox.width(), bbox.height()) / 1000
+    for _ in range(20):
+        simplified = geometry.buffer(tolerance, 2).simplify(tolerance)
+        if (
+            not simplified.isNull()
+            and simplified.constGet().nCoordinates() <= max_vertices
+        ):
+            return simplified
+        tolerance *= 2
+    return QgsGeometry.fromRect(bbox)
+
+
+def filter_polygon_wkt(geometry):
+    return simplify_filter_polygon(geometry).asWkt(WKT_PRECISION)
+
+
+class SpatialPredicate:
+    """
+    Builds SQL predicates that select the rows of a table whose geometry
+    intersects an area given in EPSG:4326. Subclasses emit predicates
+    that each provider can resolve using its spatial indexes or
+    clustering, leaving the geometry column untouched
+    """
+
+    def __init__(self, table, geom_column=None):
+        self.table = table
+        self.geom_column = geom_column or table.geom_column()
+        self.provider_type = table.schema.database.connection.provider_type
+
+    def fqn(self):
+        return quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            self.provider_type,
+        )
+
+    def for_rectangle(self, rectangle):
+        return self.for_wkt(rectangle.asWktPolygon())
+
+    def for_wkt(self, wkt):
+        return f"ST_INTERSECTS({self.geom_column}, ST_GEOGFROMTEXT('{wkt}'))"
+
+
+class BigQuerySpatialPredicate(SpatialPredicate):
+    def for_rectangle(self, rectangle):
+        # ST_INTERSECTSBOX is resolved using the clustering of the table
+        return (
+            f"ST_INTERSECTSBOX({self.geom_column}, "
+            f"{rectangle.xMinimum()}, {rectangle.yMinimum()}, "
+            f"{rectangle.xMaximum()}, {rectangle.yMaximum()})"
+        )
+
+
+class DatabricksSpatialPredicate(SpatialPredicate):
+    def for_wkt(self, wkt):
+        return f"ST_INTERSECTS(ST_GEOMFROMWKB({self.geom_column}), ST_GEOMFROMTEXT('{wkt}'))"
+
+
+class PostgresSpatialPredicate(SpatialPredicate):
+    """
+    The query area is transformed to the SRID of the geometry column,
+    which is fetched only once, so the geometry column can be compared
+    using its GiST index
+    """
+
+    def __init__(self, table, geom_column=None):
+        super().__init__(table, geom_column)
+        self._srid = None
+        self._lock = threading.Lock()
+
+    def srid(self):
+        with self._lock:
+            if self._srid is None:
+                rows = CARTO_API.execute_query(
+                    self.table.schema.database.connection.name,
+                    f"""SELECT ST_SRID({self.geom_column}) AS srid FROM {self.fqn()}
+                        WHERE {self.geom_column} IS NOT NULL LIMIT 1 ;""",
+                    cache_class="metadata",
+                )["rows"]
+                self._srid = int(rows[0]["srid"]) if rows else 0
+            return self._srid
+
+    def area(self, wkt, segment_length):
+        srid = self.srid()
+        if srid == 0:
+            return f"ST_GEOMFROMTEXT('{wkt}')"
+        area = f"ST_GEOMFROMTEXT('{wkt}', 4326)"
+        if srid == 4326:
+            return area
+        return f"ST_TRANSFORM(ST_SEGMENTIZE({area}, {segment_length}), {srid})"
+
+    def for_rectangle(self, rectangle):
+        segment_length = (
+            max(rectangle.width(), rectangle.height()) / ENVELOPE_SEGMENTS or 1
+        )
+        return self._predicate(rectangle.asWktPolygon(), segment_length)
+
+    def for_wkt(self, wkt):
+        return self._predicate(wkt, 1)
+
+    def _predicate(self, wkt, segment_length):
+        area = self.area(wkt, segment_length)
+        return f"({self.geom_column} && {area} AND ST_INTERSECTS({self.geom_column}, {area}))"
+
+
+class RedshiftSpatialPredicate(PostgresSpatialPredicate):
+    def area(self, wkt, segment_length):
+        srid = self.srid()
+        if srid == 0:
+            return f"ST_GEOMFROMTEXT('{wkt}')"
+        area = f"ST_GEOMFROMTEXT('{wkt}', 4326)"
+        if srid == 4326:
+            return area
+        return f"ST_TRANSFORM({area}, {srid})"
+
+    def _predicate(self, wkt, segment_length):
+        # Redshift has no bounding box operator, but comparing the
+        # untouched column lets it skip blocks using zone maps
+        return f"ST_INTERSECTS({self.geom_column}, {self.area(wkt, segment_length)})"
+
+
+_PREDICATE_CLASSES = {
+    "bigquery": BigQuerySpatialPredicate,
+    "postgres": PostgresSpatialPredicate,
+    "redshift": RedshiftSpatialPredicate,
+    "databricksRest": DatabricksSpatialPredicate,
+}
+
+
+def spatial_predicate_for_table(table, geom_column=None):
+    provider_type = table.schema.database.connection.provider_type
+    predicate_class = _PREDICATE_CLASSES.get(provider_type, SpatialPredicate)
+    return predicate_class(table, geom_column)
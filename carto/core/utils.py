@@ -1,17 +1,30 @@
+import os
 import uuid
 import requests
-import shutil
 from carto.gui.utils import waitcursor
 
 from qgis.PyQt.QtCore import QSettings, QVariant
 from qgis.core import NULL
 
+from carto.core.cancellation import RequestCanceled
+
 NAMESPACE = "carto"
 TOKEN = "token"
+COMPRESS_REQUESTS = "compressrequests"
 
 MAX_ROWS = 1000000
 
-setting_types = {}
+# Timeouts in seconds for establishing a connection and between received
+# bytes. Warehouse queries can take minutes before their first byte
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Size of a screen pixel in meters, as used by OGC to relate scale and resolution
+PIXEL_SIZE_METERS = 0.00028
+METERS_PER_DEGREE = 111320
+
+setting_types = {COMPRESS_REQUESTS: bool}
 
 
 def setSetting(name, value):
@@ -27,10 +40,20 @@ def setting(name):
 
 
 @waitcursor
-def download_file(url, filename):
-    with requests.get(url, stream=True) as r:
-        with open(filename, "wb") as f:
-            shutil.copyfileobj(r.raw, f)
+def download_file(url, filename, token=None):
+    try:
+        with requests.get(
+            url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+        ) as r:
+            r.raise_for_status()
+            with open(filename, "wb") as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    if token is not None:
+                        token.raise_if_canceled()
+                    f.write(chunk)
+    except RequestCanceled:
+        os.remove(filename)
+        raise
 
 
 def quote_for_provider(value, provider_type):
@@ -56,6 +79,81 @@ def quote_column_name_for_provider(value, provider_type):
         return value
 
 
+def tolerance_for_scale(scale):
+    return scale * PIXEL_SIZE_METERS
+
+
+def simplified_geometry_for_provider(provider_type, geom_column, tolerance):
+    # tolerance is in meters, and converted to degrees for planar
+    # geometries in geographic coordinates
+    degrees = tolerance / METERS_PER_DEGREE
+    if provider_type == "databricksRest":
+        return f"ST_ASWKB(ST_SIMPLIFY(ST_GEOMFROMWKB({geom_column}), {degrees}))"
+    elif provider_type == "postgres":
+        return f"""CASE
+                WHEN ST_SRID({geom_column}) IN (0, 4326) THEN
+                    ST_SIMPLIFYPRESERVETOPOLOGY({geom_column}, {degrees})
+                ELSE
+                    ST_SIMPLIFYPRESERVETOPOLOGY({geom_column}, {tolerance})
+                END"""
+    elif provider_type == "redshift":
+        return f"""CASE
+                WHEN ST_SRID({geom_column}) IN (0, 4326) THEN
+                    ST_SIMPLIFY({geom_column}, {degrees})
+                ELSE
+                    ST_SIMPLIFY({geom_column}, {tolerance})
+                END"""
+    else:
+        return f"ST_SIMPLIFY({geom_column}, {tolerance})"
+
+
+# Maximum length of a single SQL statement accepted by each provider, with
+# some margin left for the code added by prepare_multipart_sql
+MAX_STATEMENT_SIZES = {
+    "bigquery": 1000000,
+    "snowflake": 1000000,
+    "redshift": 16000000,
+    "postgres": 16000000,
+    "databricksRest": 1000000,
+}
+DEFAULT_MAX_STATEMENT_SIZE = 1000000
+MULTIPART_SQL_OVERHEAD = 1000
+
+
+def max_statement_size(provider):
+    return (
+        MAX_STATEMENT_SIZES.get(provider, DEFAULT_MAX_STATEMENT_SIZE)
+        - MULTIPART_SQL_OVERHEAD
+    )
+
+
+def split_statements(statements, max_size, max_statements=None):
+    """
+    Groups statements in batches whose joined length does not exceed the
+    given size. A statement that is larger than it on its own can not be
+    split and raises a ValueError
+    """
+    batch = []
+    batch_size = 0
+    for statement in statements:
+        size = len(statement) + 1
+        if size > max_size:
+            raise ValueError(
+                f"SQL statement is too large ({size} characters, maximum is {max_size})"
+            )
+        if batch and (
+            batch_size + size > max_size
+            or (max_statements and len(batch) >= max_statements)
+        ):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(statement)
+        batch_size += size
+    if batch:
+        yield batch
+
+
 def prepare_multipart_sql(statements, provider, fqn):
     joined = "\n".join(statements)
     if provider == "redshift":
@@ -0,0 +1,43 @@
+import os
+
+from qgis.utils import iface
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtWidgets import QDialog
+
+from carto.core.dynamiclayer import AGGREGATION_FUNCTIONS, NUMERIC_COLUMN_TYPES
+
+WIDGET, BASE = uic.loadUiType(
+    os.path.join(os.path.dirname(__file__), "aggregationdialog.ui")
+)
+
+
+class AggregationDialog(BASE, WIDGET):
+    def __init__(self, table, parent=None):
+        parent = parent or iface.mainWindow()
+        super(QDialog, self).__init__(parent)
+        self.setupUi(self)
+        self.table = table
+        self.aggregates = []
+
+        self.buttonBox.accepted.connect(self.okClicked)
+        self.buttonBox.rejected.connect(self.reject)
+
+        self.initGui()
+
+    def initGui(self):
+        columns = [
+            c["name"]
+            for c in self.table.columns()
+            if str(c.get("type", "")).lower() in NUMERIC_COLUMN_TYPES
+        ]
+        self.comboColumn.addItems(columns)
+        self.comboFunction.addItems(AGGREGATION_FUNCTIONS)
+        self.grpAggregate.setEnabled(bool(columns))
+
+    def okClicked(self):
+        if self.grpAggregate.isChecked():
+            self.aggregates = [
+                (self.comboColumn.currentText(), self.comboFunction.currentText())
+            ]
+        self.accept()
@@ -17,6 +17,7 @@ from carto.gui.authorizationsuccessdialog import AuthorizationSuccessDialog
 from carto.core.auth import OAuthWorkflow
 from carto.core.enums import AuthState
 from carto.core.api import CARTO_API
+from carto.core.authconfig import remove_bearer_auth_config
 from carto.gui.utils import icon
 
 AUTH_CONFIG_ID = "carto_auth_id"
@@ -102,6 +103,7 @@ class AuthorizationManager(QObject):
         Deauthorizes the client
         """
         CARTO_API.set_token(None)
+        remove_bearer_auth_config()
         print("Deauthorized")
         self._set_status(AuthState.NotAuthorized)
 
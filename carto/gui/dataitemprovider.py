@@ -11,6 +11,8 @@ from qgis.core import (
     QgsProject,
     Qgis,
     QgsVectorTileLayer,
+    QgsVectorTileBasicRenderer,
+    QgsDataSourceUri,
     QgsMessageOutput,
     QgsApplication,
     QgsMessageLog,
@@ -19,14 +21,19 @@ from qgis.core import (
 from qgis.utils import iface
 from functools import partial
 
+from carto.core.api import CARTO_API
+from carto.core.authconfig import bearer_auth_config, AuthConfigError
 from carto.core.connection import CARTO_CONNECTION
 from carto.core.layers import layer_metadata
+from carto.core.logging import error
 from carto.core.utils import MAX_ROWS
 from carto.gui.importdialog import ImportDialog
 from carto.gui.downloadfilteredlayerdialog import DownloadFilteredLayerDialog
+from carto.gui.aggregationdialog import AggregationDialog
 from carto.gui.authorization_manager import AUTHORIZATION_MANAGER
 from carto.core.downloadtabletask import DownloadTableTask
-from carto.gui.utils import icon
+from carto.core.dynamiclayer import add_dynamic_layer, add_aggregated_layer
+from carto.gui.utils import icon, waitcursor
 
 
 cartoIcon = icon("carto.svg")
@@ -248,6 +255,22 @@ class TableItem(QgsDataItem):
         add_layer_filtered_action.triggered.connect(self.add_layer_filtered)
         actions.append(add_layer_filtered_action)
 
+        add_dynamic_layer_action = QAction(
+            QIcon(), "Add Dynamic Layer (Visible Extent)", parent
+        )
+        add_dynamic_layer_action.triggered.connect(self.add_dynamic_layer)
+        actions.append(add_dynamic_layer_action)
+
+        add_aggregated_layer_action = QAction(
+            QIcon(), "Add Aggregated Overview Layer...", parent
+        )
+        add_aggregated_layer_action.triggered.connect(self.add_aggregated_layer)
+        actions.append(add_aggregated_layer_action)
+
+        add_vector_tiles_action = QAction(QIcon(), "Add as Vector Tiles", parent)
+        add_vector_tiles_action.triggered.connect(self.add_vector_tile_layer)
+        actions.append(add_vector_tiles_action)
+
         table_info_action = QAction(QIcon(), "Table Info...", parent)
         table_info_action.triggered.connect(self.table_info_action)
         actions.append(table_info_action)
@@ -269,16 +292,65 @@ class TableItem(QgsDataItem):
         dlg.show()
         ret = dlg.exec_()
         if ret == QDialog.Accepted:
-            self._add_layer(dlg.where, dlg.limit)
+            self._add_layer(
+                dlg.where, dlg.limit, dlg.tolerance, dlg.columns, dlg.extent
+            )
 
     def add_layer(self):
         self._add_layer(None)
 
-    def _add_layer(self, where=None, limit=None):
+    @waitcursor
+    def add_dynamic_layer(self):
+        add_dynamic_layer(self.table)
+
+    def add_aggregated_layer(self):
+        dlg = AggregationDialog(self.table)
+        ret = dlg.exec_()
+        if ret == QDialog.Accepted:
+            add_aggregated_layer(self.table, dlg.aggregates)
+
+    def add_vector_tile_layer(self):
+        try:
+            tileset = self.table.tileset()
+            url = tileset["tiles"][0]
+        except Exception as e:
+            iface.messageBar().pushMessage(
+                f"Could not get vector tiles for {self.table.name}",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            error(f"Could not get vector tiles for {self.table.name}: {e}")
+            return
+        try:
+            authcfg = bearer_auth_config(CARTO_API.token)
+        except AuthConfigError as e:
+            iface.messageBar().pushMessage(
+                f"Could not add vector tiles for {self.table.name}: {e}",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            return
+        uri = QgsDataSourceUri()
+        uri.setParam("type", "xyz")
+        uri.setParam("url", url)
+        # The token is sent by the authentication configuration, so it is
+        # neither part of the tile URLs nor saved in project files
+        uri.setAuthConfigId(authcfg)
+        uri.setParam("zmin", str(tileset.get("minzoom", 0)))
+        uri.setParam("zmax", str(tileset.get("maxzoom", 14)))
+        layer = QgsVectorTileLayer(bytes(uri.encodedUri()).decode(), self.table.name)
+        renderer = QgsVectorTileBasicRenderer()
+        renderer.setStyles(QgsVectorTileBasicRenderer.simpleStyleWithRandomColors())
+        layer.setRenderer(renderer)
+        QgsProject.instance().addMapLayer(layer)
+
+    def _add_layer(
+        self, where=None, limit=None, tolerance=None, columns=None, extent=None
+    ):
         where = where or "TRUE"
         limit = limit or MAX_ROWS
 
-        task = DownloadTableTask(self.table, where, limit)
+        task = DownloadTableTask(self.table, where, limit, tolerance, columns, extent)
 
         def _show_terminated_message():
             iface.messageBar().pushMessage(
@@ -313,7 +385,14 @@ class TableItem(QgsDataItem):
 
         QgsProject.instance().addMapLayer(layer)
         metadata = layer_metadata(layer)
-        if not metadata["can_write"]:
+        if metadata.get("lod"):
+            iface.messageBar().pushMessage(
+                "Read-only",
+                "Geometries were simplified. Layer can not be edited",
+                level=Qgis.Warning,
+                duration=10,
+            )
+        elif not metadata["can_write"]:
             iface.messageBar().pushMessage(
                 "Read-only",
                 "No permission to write. Local changes will not be saved to the original table",
@@ -4,6 +4,7 @@ from qgis.core import (
     Qgis,
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
+    QgsGeometry,
     QgsPointXY,
     QgsProject,
     QgsRectangle,
@@ -13,10 +14,12 @@ from qgis.gui import QgsMessageBar
 
 from qgis.PyQt import uic
 from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtWidgets import QDialog, QSizePolicy
+from qgis.PyQt.QtWidgets import QDialog, QSizePolicy, QListWidgetItem
 
 from carto.gui.extentselectionpanel import ExtentSelectionPanel
-from carto.core.utils import MAX_ROWS
+from carto.core.expressions import compile_expression, ExpressionCompileError
+from carto.core.spatialfilter import spatial_predicate_for_table, filter_polygon_wkt
+from carto.core.utils import MAX_ROWS, tolerance_for_scale
 
 
 WIDGET, BASE = uic.loadUiType(
@@ -32,6 +35,9 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
         self.table = table
         self.where = None
         self.limit = None
+        self.tolerance = None
+        self.columns = None
+        self.extent = None
         self.connection = connection
         self.bar = QgsMessageBar()
         self.bar.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Fixed)
@@ -43,6 +49,15 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
         self.extentPanel = ExtentSelectionPanel(self)
         self.grpSpatialFilter.layout().addWidget(self.extentPanel, 1, 0)
 
+        geom_column = self.table.geom_column()
+        for column in self.table.columns():
+            if column["name"] == geom_column:
+                continue
+            item = QListWidgetItem(column["name"])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked)
+            self.listColumns.addItem(item)
+
     def okClicked(self):
         statements = []
         if self.grpSpatialFilter.isChecked():
@@ -64,31 +79,38 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
             rectangle4326 = QgsRectangle(
                 bottom_left.x(), bottom_left.y(), top_right.x(), top_right.y()
             )
-            if self.connection.provider_type == "databricksRest":
-                statements.append(
-                    f"ST_INTERSECTS(ST_GEOMFROMWKB({geom_column}), ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'))"
-                )
-            elif self.connection.provider_type in ["postgres", "redshift"]:
-                statements.append(
-                    f"""CASE
-                        WHEN ST_SRID(geom) = 0 THEN
-                            ST_INTERSECTS(
-                                ST_SETSRID({geom_column}, 4326),
-                                ST_SETSRID(ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'), 4326)
-                            )
-                        ELSE
-                            ST_INTERSECTS(
-                                ST_TRANSFORM({geom_column}, 4326),
-                                ST_SETSRID(ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'), 4326)
-                            )
-                        END"""
+            predicate = spatial_predicate_for_table(self.table, geom_column)
+            polygon = self.extentPanel.getPolygon()
+            self.extent = rectangle4326 if self.chkTiled.isChecked() else None
+            if polygon is not None:
+                polygon4326 = QgsGeometry(polygon)
+                polygon4326.transform(
+                    QgsCoordinateTransform(
+                        polygon.crs(), destination_crs, QgsProject.instance()
+                    )
                 )
+                statements.append(predicate.for_wkt(filter_polygon_wkt(polygon4326)))
+            elif self.extent is not None:
+                statements.append("TRUE")
             else:
-                statements.append(
-                    f"ST_INTERSECTS({geom_column}, ST_GEOGFROMTEXT('{rectangle4326.asWktPolygon()}'))"
-                )
+                statements.append(predicate.for_rectangle(rectangle4326))
         elif self.grpWhereFilter.isChecked():
-            statements.append(self.txtWhere.text())
+            if self.chkExpression.isChecked():
+                try:
+                    statements.append(
+                        compile_expression(
+                            self.txtWhere.text(), self.connection.provider_type
+                        )
+                    )
+                except ExpressionCompileError as e:
+                    self.bar.pushMessage(
+                        f"Expression can not be used as filter: {e}",
+                        Qgis.Warning,
+                        duration=5,
+                    )
+                    return
+            else:
+                statements.append(self.txtWhere.text())
         elif not self.grpLimit.isChecked():
             self.bar.pushMessage("Please select a filter", Qgis.Warning, duration=5)
             return
@@ -109,4 +131,24 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
                 return
         else:
             self.limit = MAX_ROWS
+        if self.grpSimplify.isChecked():
+            try:
+                scale = float(self.txtScale.text())
+            except ValueError:
+                self.bar.pushMessage("Invalid target scale", Qgis.Warning, duration=5)
+                return
+            if scale <= 0:
+                self.bar.pushMessage("Invalid target scale", Qgis.Warning, duration=5)
+                return
+            self.tolerance = tolerance_for_scale(scale)
+        else:
+            self.tolerance = None
+        if self.grpColumns.isChecked():
+            self.columns = [
+                self.listColumns.item(i).text()
+                for i in range(self.listColumns.count())
+                if self.listColumns.item(i).checkState() == Qt.Checked
+            ]
+        else:
+            self.columns = None
         self.accept()
@@ -9,10 +9,15 @@ from qgis.PyQt.QtGui import QCursor
 
 from qgis.utils import iface
 from qgis.core import (
+    Qgis,
     QgsCoordinateReferenceSystem,
+    QgsGeometry,
     QgsProject,
     QgsRectangle,
+    QgsReferencedGeometry,
     QgsReferencedRectangle,
+    QgsVectorLayer,
+    QgsWkbTypes,
 )
 
 from processing.gui.ExtentSelectionPanel import LayerSelectionDialog
@@ -31,6 +36,11 @@ class ExtentSelectionPanel(BASE, WIDGET):
 
         self.crsSelector.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
         self.dialog = dialog
+        self.polygon = None
+
+        for widget in [self.txtNorth, self.txtSouth, self.txtEast, self.txtWest]:
+            widget.textEdited.connect(self.clearPolygon)
+        self.crsSelector.crsChanged.connect(self.clearPolygon)
 
         self.btnSetFrom.clicked.connect(self.selectExtent)
 
@@ -43,15 +53,20 @@ class ExtentSelectionPanel(BASE, WIDGET):
         popupmenu = QMenu()
         useCanvasExtentAction = QAction("Use Canvas Extent", self.btnSetFrom)
         useLayerExtentAction = QAction("Use Layer Extent…", self.btnSetFrom)
+        useLayerFeaturesAction = QAction(
+            "Use Selected Features of Layer…", self.btnSetFrom
+        )
         selectOnCanvasAction = QAction("Select Extent on Canvas", self.btnSetFrom)
 
         popupmenu.addAction(useCanvasExtentAction)
         popupmenu.addAction(selectOnCanvasAction)
         popupmenu.addSeparator()
         popupmenu.addAction(useLayerExtentAction)
+        popupmenu.addAction(useLayerFeaturesAction)
 
         selectOnCanvasAction.triggered.connect(self.selectOnCanvas)
         useLayerExtentAction.triggered.connect(self.useLayerExtent)
+        useLayerFeaturesAction.triggered.connect(self.useLayerFeatures)
         useCanvasExtentAction.triggered.connect(self.useCanvasExtent)
 
         popupmenu.exec_(QCursor.pos())
@@ -62,6 +77,31 @@ class ExtentSelectionPanel(BASE, WIDGET):
             layer = dlg.selected_layer()
             self.setValueFromRect(QgsReferencedRectangle(layer.extent(), layer.crs()))
 
+    def useLayerFeatures(self):
+        dlg = LayerSelectionDialog(self)
+        if dlg.exec_():
+            layer = dlg.selected_layer()
+            if not isinstance(layer, QgsVectorLayer):
+                return
+            if layer.selectedFeatureCount():
+                features = layer.getSelectedFeatures()
+            else:
+                features = layer.getFeatures()
+            geometries = [f.geometry() for f in features if f.hasGeometry()]
+            polygon = QgsGeometry.unaryUnion(geometries)
+            if polygon.isNull() or polygon.type() != QgsWkbTypes.PolygonGeometry:
+                self.dialog.bar.pushMessage(
+                    "Selected features are not polygons", Qgis.Warning, duration=5
+                )
+                return
+            self.setValueFromRect(
+                QgsReferencedRectangle(polygon.boundingBox(), layer.crs())
+            )
+            self.polygon = QgsReferencedGeometry(polygon, layer.crs())
+
+    def clearPolygon(self):
+        self.polygon = None
+
     def useCanvasExtent(self):
         self.setValueFromRect(
             QgsReferencedRectangle(
@@ -86,6 +126,7 @@ class ExtentSelectionPanel(BASE, WIDGET):
         self.dialog.activateWindow()
 
     def setValueFromRect(self, r):
+        self.polygon = None
         self.txtNorth.setText(str(r.yMaximum()))
         self.txtSouth.setText(str(r.yMinimum()))
         self.txtEast.setText(str(r.xMaximum()))
@@ -94,7 +135,9 @@ class ExtentSelectionPanel(BASE, WIDGET):
             crs = r.crs()
         except Exception:
             crs = QgsProject.instance().crs()
+        self.crsSelector.blockSignals(True)
         self.crsSelector.setCrs(crs)
+        self.crsSelector.blockSignals(False)
 
     def getExtent(self):
         try:
@@ -108,3 +151,6 @@ class ExtentSelectionPanel(BASE, WIDGET):
             return None
         rect = QgsRectangle(coords[0], coords[1], coords[2], coords[3])
         return QgsReferencedRectangle(rect, self.crsSelector.crs())
+
+    def getPolygon(self):
+        return self.polygon
@@ -0,0 +1,133 @@
+import os
+import time
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtCore import QTimer
+from qgis.PyQt.QtWidgets import QDockWidget, QTableWidgetItem, QHeaderView
+
+from carto.core.instrumentation import INSTRUMENTATION
+from carto.core.scheduler import SCHEDULER
+
+WIDGET, BASE = uic.loadUiType(
+    os.path.join(os.path.dirname(__file__), "performancedock.ui")
+)
+
+REFRESH_INTERVAL_MS = 1000
+
+# Spans added up to tell where the time of a task goes
+DECODE_SPANS = ["json_decode", "json_stream_decode", "arrow_decode", "feature_decode"]
+WRITE_SPANS = ["feature_write", "geopackage_flush"]
+
+
+class PerformanceDock(BASE, WIDGET):
+    def __init__(self, parent=None):
+        super(QDockWidget, self).__init__(parent)
+        self.setupUi(self)
+
+        self._setup_table(self.tableRequests, ["Connection", "In flight", "Queued"])
+        self._setup_table(
+            self.tableTasks,
+            [
+                "Task",
+                "Elapsed",
+                "Rows/s",
+                "MB/s",
+                "Warehouse",
+                "Network",
+                "Decode",
+                "Write",
+                "Bottleneck",
+            ],
+        )
+        self._setup_table(
+            self.tableSlowQueries, ["Time", "Connection", "Seconds", "Query"]
+        )
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL_MS)
+        self.timer.timeout.connect(self.refresh)
+        # The panel is only refreshed while it can be seen. Statistics are
+        # collected all the time, so they are up to date when it is shown
+        self.visibilityChanged.connect(self._visibility_changed)
+
+    def _setup_table(self, table, headers):
+        table.setColumnCount(len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.verticalHeader().setVisible(False)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        table.horizontalHeader().setStretchLastSection(True)
+
+    def _visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        self._refresh_requests()
+        self._refresh_tasks()
+        self._refresh_caches()
+        self._refresh_slow_queries()
+
+    def _fill_table(self, table, rows):
+        table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                table.setItem(i, j, QTableWidgetItem(str(value)))
+
+    def _refresh_requests(self):
+        in_flight = SCHEDULER.in_flight()
+        queued = SCHEDULER.queued()
+        connections = sorted(set(in_flight) | set(queued))
+        self._fill_table(
+            self.tableRequests,
+            [(c, in_flight.get(c, 0), queued.get(c, 0)) for c in connections],
+        )
+
+    def _refresh_tasks(self):
+        rows = []
+        for stats in INSTRUMENTATION.running_tasks():
+            elapsed = max(stats.elapsed(), 0.001)
+            times, counts = stats.snapshot()
+            # Requests are timed until their whole body is received, except
+            # for streamed ones, whose transfer is part of decoding
+            warehouse = times.get("query_wait", 0)
+            breakdown = {
+                "Warehouse": warehouse,
+                "Network": max(0, times.get("request", 0) - warehouse),
+                "Decode": sum(times.get(name, 0) for name in DECODE_SPANS),
+                "Write": sum(times.get(name, 0) for name in WRITE_SPANS),
+            }
+            bottleneck = max(breakdown, key=breakdown.get)
+            rows.append(
+                [
+                    stats.name,
+                    f"{elapsed:.0f}s",
+                    f"{counts.get('rows', 0) / elapsed:.0f}",
+                    f"{counts.get('bytes_in', 0) / elapsed / 1024 / 1024:.2f}",
+                ]
+                + [f"{seconds:.1f}s" for seconds in breakdown.values()]
+                + [bottleneck if any(breakdown.values()) else "-"]
+            )
+        self._fill_table(self.tableTasks, rows)
+
+    def _refresh_caches(self):
+        for label, name in [
+            (self.labelQueryCache, "query_cache"),
+            (self.labelHttpCache, "http_cache"),
+        ]:
+            ratio = INSTRUMENTATION.hit_ratio(name)
+            label.setText("-" if ratio is None else f"{ratio:.0%} hits")
+
+    def _refresh_slow_queries(self):
+        rows = [
+            (
+                time.strftime("%H:%M:%S", time.localtime(query["time"])),
+                query["connection"],
+                f"{query['seconds']:.1f}",
+                query["query"],
+            )
+            for query in reversed(INSTRUMENTATION.slow_queries)
+        ]
+        self._fill_table(self.tableSlowQueries, rows)
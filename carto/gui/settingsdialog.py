@@ -1,6 +1,6 @@
 import os
 
-from carto.core.utils import setting, setSetting, TOKEN
+from carto.core.utils import setting, setSetting, TOKEN, COMPRESS_REQUESTS
 from qgis.gui import QgsMessageBar
 
 from qgis.PyQt import uic
@@ -27,7 +27,9 @@ class SettingsDialog(BASE, WIDGET):
 
     def setValues(self):
         self.txtToken.setText(setting(TOKEN))
+        self.chkCompressRequests.setChecked(setting(COMPRESS_REQUESTS))
 
     def okClicked(self):
         setSetting(TOKEN, self.txtToken.text())
+        setSetting(COMPRESS_REQUESTS, self.chkCompressRequests.isChecked())
         self.accept()
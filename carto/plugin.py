@@ -1,13 +1,16 @@
 import os
 
-from qgis.core import QgsProject, QgsApplication
+from qgis.core import QgsProject, QgsApplication, Qgis
 
-from qgis.PyQt.QtWidgets import QMenu, QAction
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtWidgets import QMenu, QAction, QFileDialog
 
 from carto.gui.dataitemprovider import DataItemProvider
 from carto.gui.authorizationsuccessdialog import AuthorizationSuccessDialog
+from carto.gui.performancedock import PerformanceDock
 from carto.core.layers import LayerTracker
 from carto.core.api import CARTO_API
+from carto.core.instrumentation import INSTRUMENTATION
 
 from qgis.utils import iface
 
@@ -32,6 +35,17 @@ class CartoPlugin(object):
 
         self.carto_menu.addAction(AUTHORIZATION_MANAGER.login_action)
 
+        self.trace_action = QAction("Export Performance Trace…")
+        self.trace_action.triggered.connect(self.export_trace)
+        self.carto_menu.addAction(self.trace_action)
+
+        self.performance_dock = PerformanceDock(self.iface.mainWindow())
+        self.iface.addDockWidget(Qt.RightDockWidgetArea, self.performance_dock)
+        self.performance_dock.hide()
+        performance_action = self.performance_dock.toggleViewAction()
+        performance_action.setText("Performance Monitor")
+        self.carto_menu.addAction(performance_action)
+
         self.login_action = QAction()
         self.login_action.setIcon(CARTO_ICON)
         self.login_action.triggered.connect(self.login)
@@ -50,11 +64,31 @@ class CartoPlugin(object):
         QgsProject.instance().layerRemoved.disconnect(self.tracker.layer_removed)
         QgsProject.instance().layerWasAdded.disconnect(self.tracker.layer_added)
 
+        self.performance_dock.timer.stop()
+        self.iface.removeDockWidget(self.performance_dock)
+        self.performance_dock.deleteLater()
+        self.performance_dock = None
+
         self.iface.removeWebToolBarIcon(self.login_action)
         self.carto_menu.clear()
         self.iface.webMenu().removeAction(self.carto_menu.menuAction())
         self.carto_menu = None
 
+    def export_trace(self):
+        filename, _ = QFileDialog.getSaveFileName(
+            iface.mainWindow(),
+            "Export Performance Trace",
+            "",
+            "Chrome trace files (*.json)",
+        )
+        if filename:
+            count = INSTRUMENTATION.export_chrome_trace(filename)
+            iface.messageBar().pushMessage(
+                f"{count} events exported to {filename}",
+                level=Qgis.Info,
+                duration=5,
+            )
+
     def login(self):
         if AUTHORIZATION_MANAGER.is_authorized():
             try:
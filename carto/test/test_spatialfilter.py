@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+import pytest
+
+qgis_core = pytest.importorskip("qgis.core")
+
+from carto.core.spatialfilter import (  # noqa: E402
+    BigQuerySpatialPredicate,
+    DatabricksSpatialPredicate,
+    PostgresSpatialPredicate,
+    RedshiftSpatialPredicate,
+    SpatialPredicate,
+    spatial_predicate_for_table,
+)
+
+RECTANGLE = qgis_core.QgsRectangle(-10, 40, 5, 50)
+WKT = RECTANGLE.asWktPolygon()
+
+
+def make_table(provider_type, geom_column="geom"):
+    connection = SimpleNamespace(name="conn", provider_type=provider_type)
+    database = SimpleNamespace(databaseid="db", connection=connection)
+    schema = SimpleNamespace(schemaid="schema", database=database)
+    return SimpleNamespace(
+        tableid="table",
+        name="table",
+        schema=schema,
+        geom_column=lambda: geom_column,
+    )
+
+
+def make_predicate(provider_type, srid=None):
+    predicate = spatial_predicate_for_table(make_table(provider_type))
+    if srid is not None:
+        # Avoids querying the SRID of the geometry column
+        predicate._srid = srid
+    return predicate
+
+
+@pytest.mark.parametrize(
+    "provider_type, predicate_class",
+    [
+        ("bigquery", BigQuerySpatialPredicate),
+        ("postgres", PostgresSpatialPredicate),
+        ("redshift", RedshiftSpatialPredicate),
+        ("databricksRest", DatabricksSpatialPredicate),
+        ("snowflake", SpatialPredicate),
+    ],
+)
+def test_predicate_class_for_provider(provider_type, predicate_class):
+    assert type(make_predicate(provider_type)) is predicate_class
+
+
+def test_geom_column_defaults_to_table_geometry():
+    table = make_table("bigquery", geom_column="the_geom")
+    assert spatial_predicate_for_table(table).geom_column == "the_geom"
+    assert spatial_predicate_for_table(table, "other").geom_column == "other"
+
+
+def test_bigquery_uses_intersectsbox_for_rectangles():
+    predicate = make_predicate("bigquery")
+    assert predicate.for_rectangle(RECTANGLE) == (
+        "ST_INTERSECTSBOX(geom, -10.0, 40.0, 5.0, 50.0)"
+    )
+
+
+def test_bigquery_uses_geography_for_polygons():
+    predicate = make_predicate("bigquery")
+    assert predicate.for_wkt(WKT) == f"ST_INTERSECTS(geom, ST_GEOGFROMTEXT('{WKT}'))"
+
+
+def test_postgres_transforms_segmentized_envelope():
+    predicate = make_predicate("postgres", srid=3857)
+    area = (
+        f"ST_TRANSFORM(ST_SEGMENTIZE(ST_GEOMFROMTEXT('{WKT}', 4326), "
+        f"{15 / 32}), 3857)"
+    )
+    assert predicate.for_rectangle(RECTANGLE) == (
+        f"(geom && {area} AND ST_INTERSECTS(geom, {area}))"
+    )
+
+
+def test_postgres_does_not_transform_4326():
+    predicate = make_predicate("postgres", srid=4326)
+    area = f"ST_GEOMFROMTEXT('{WKT}', 4326)"
+    assert predicate.for_wkt(WKT) == (
+        f"(geom && {area} AND ST_INTERSECTS(geom, {area}))"
+    )
+
+
+def test_postgres_without_srid():
+    predicate = make_predicate("postgres", srid=0)
+    area = f"ST_GEOMFROMTEXT('{WKT}')"
+    assert predicate.for_wkt(WKT) == (
+        f"(geom && {area} AND ST_INTERSECTS(geom, {area}))"
+    )
+
+
+def test_redshift_transforms_area_without_bbox_operator():
+    predicate = make_predicate("redshift", srid=3857)
+    result = predicate.for_rectangle(RECTANGLE)
+    assert result == (
+        f"ST_INTERSECTS(geom, ST_TRANSFORM(ST_GEOMFROMTEXT('{WKT}', 4326), 3857))"
+    )
+    assert "&&" not in result
+
+
+def test_databricks_decodes_wkb_column():
+    predicate = make_predicate("databricksRest")
+    assert predicate.for_rectangle(RECTANGLE) == (
+        f"ST_INTERSECTS(ST_GEOMFROMWKB(geom), ST_GEOMFROMTEXT('{WKT}'))"
+    )